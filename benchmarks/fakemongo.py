@@ -0,0 +1,357 @@
+"""
+In-process stand-in for the parts of Motor that the service uses.
+
+Documents are kept in dictionaries and queries are evaluated in
+Python, so no MongoDB server is required.  Equality lookups on
+``_id``, ``user_id`` and ``email`` use a hash index; everything else
+scans the collection.  Set `latency` to add a simulated round trip
+to every operation.
+
+Only the query operators that the service issues are implemented:
+equality, ``$lt``, ``$lte``, ``$gt``, ``$gte``, ``$in``, ``$ne``,
+``$exists``, ``$regex``, ``$and`` and ``$or``.  A condition on an
+array field matches if any element matches.
+
+"""
+import collections
+import functools
+import re
+
+from tornado import gen
+import bson.objectid
+import pymongo.errors
+
+
+INDEXED_FIELDS = ('_id', 'user_id', 'email')
+
+
+class FakeMotorClient(object):
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._databases = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._databases[name]
+        except KeyError:
+            database = self._databases[name] = FakeDatabase(self, name)
+            return database
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_database(self, name, **options):
+        return self[name]
+
+
+class FakeDatabase(object):
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._collections[name]
+        except KeyError:
+            collection = self._collections[name] = FakeCollection(self, name)
+            return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    async def command(self, name):
+        if self.client.latency:
+            await gen.sleep(self.client.latency)
+        return {'ok': 1.0}
+
+
+class InsertManyResult(object):
+
+    def __init__(self, inserted_ids):
+        self.inserted_ids = inserted_ids
+
+
+class UpdateResult(object):
+
+    def __init__(self, matched_count):
+        self.matched_count = matched_count
+
+
+class DeleteResult(object):
+
+    def __init__(self, deleted_count):
+        self.deleted_count = deleted_count
+
+
+class FakeCollection(object):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.documents = {}
+        self.indexes = {}
+        self._lookup = {field: collections.defaultdict(set)
+                        for field in INDEXED_FIELDS}
+
+    async def _round_trip(self):
+        if self.database.client.latency:
+            await gen.sleep(self.database.client.latency)
+
+    def seed(self, docs):
+        """Load `docs` synchronously without simulating latency."""
+        for doc in docs:
+            self._store(doc)
+
+    def _store(self, doc):
+        doc = dict(doc)
+        doc.setdefault('_id', bson.objectid.ObjectId())
+        if doc['_id'] in self.documents:
+            self._remove(doc['_id'])
+        self.documents[doc['_id']] = doc
+        for field, lookup in self._lookup.items():
+            if field in doc:
+                lookup[doc[field]].add(doc['_id'])
+        return doc['_id']
+
+    def _remove(self, doc_id):
+        doc = self.documents.pop(doc_id)
+        for field, lookup in self._lookup.items():
+            if field in doc:
+                lookup[doc[field]].discard(doc_id)
+
+    def _candidates(self, query):
+        for field in INDEXED_FIELDS:
+            value = query.get(field)
+            if value is not None and not isinstance(value, dict):
+                return [self.documents[doc_id]
+                        for doc_id in self._lookup[field].get(value, ())]
+        return list(self.documents.values())
+
+    def _find(self, query):
+        if query is None:
+            query = {}
+        elif not isinstance(query, dict):
+            query = {'_id': query}
+        return [doc for doc in self._candidates(query)
+                if matches(doc, query)]
+
+    def with_options(self, **options):
+        return self
+
+    async def find_one(self, query=None, projection=None):
+        await self._round_trip()
+        found = self._find(query)
+        return project(found[0], projection) if found else None
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(self, query, projection)
+
+    async def replace_one(self, query, doc, upsert=False):
+        await self._round_trip()
+        found = self._find(query)
+        if found:
+            doc = dict(doc, _id=found[0]['_id'])
+        elif not upsert:
+            return
+        self._store(doc)
+
+    async def insert_many(self, docs, ordered=True):
+        await self._round_trip()
+        inserted, write_errors = [], []
+        for index, doc in enumerate(docs):
+            if doc.get('_id') in self.documents:
+                write_errors.append({'index': index, 'code': 11000,
+                                     'errmsg': 'duplicate key'})
+                if ordered:
+                    break
+                continue
+            inserted.append(self._store(doc))
+        if write_errors:
+            raise pymongo.errors.BulkWriteError(
+                {'writeErrors': write_errors, 'nInserted': len(inserted)})
+        return InsertManyResult(inserted)
+
+    async def delete_one(self, query):
+        await self._round_trip()
+        found = self._find(query)
+        if found:
+            self._remove(found[0]['_id'])
+        return DeleteResult(len(found[:1]))
+
+    async def find_one_and_delete(self, query, projection=None):
+        await self._round_trip()
+        found = self._find(query)
+        if not found:
+            return None
+        self._remove(found[0]['_id'])
+        return project(found[0], projection)
+
+    async def delete_many(self, query):
+        await self._round_trip()
+        found = self._find(query)
+        for doc in found:
+            self._remove(doc['_id'])
+        return DeleteResult(len(found))
+
+    async def update_one(self, query, update):
+        await self._round_trip()
+        found = self._find(query)
+        if found:
+            found[0].update(update.get('$set', {}))
+        return UpdateResult(len(found[:1]))
+
+    async def find_one_and_update(self, query, update, projection=None,
+                                  return_document=False):
+        await self._round_trip()
+        found = self._find(query)
+        if not found:
+            return None
+        doc = found[0]
+        for field, amount in update.get('$inc', {}).items():
+            doc[field] = doc.get(field, 0) + amount
+        return dict(doc)
+
+    async def create_indexes(self, models):
+        await self._round_trip()
+        names = []
+        for model in models:
+            name = model.document['name']
+            self.indexes[name] = model.document
+            names.append(name)
+        return names
+
+    async def index_information(self):
+        await self._round_trip()
+        information = {'_id_': {'key': [('_id', 1)]}}
+        information.update(self.indexes)
+        return information
+
+
+class FakeCursor(object):
+
+    def __init__(self, collection, query, projection=None):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self._sort = []
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        if direction is None:
+            self._sort = list(key_or_list)
+        else:
+            self._sort = [(key_or_list, direction)]
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def _evaluate(self):
+        if self._results is None:
+            docs = self.collection._find(self.query)
+            docs.sort(key=functools.cmp_to_key(self._compare))
+            if self._limit:
+                docs = docs[:self._limit]
+            self._results = collections.deque(
+                project(doc, self.projection) for doc in docs)
+        return self._results
+
+    def _compare(self, left, right):
+        for key, direction in self._sort:
+            a, b = left.get(key), right.get(key)
+            if a != b:
+                return direction if a > b else -direction
+        return 0
+
+    async def to_list(self, length):
+        await self.collection._round_trip()
+        results = self._evaluate()
+        count = len(results) if length is None else min(length, len(results))
+        return [results.popleft() for _ in range(count)]
+
+    @property
+    async def fetch_next(self):
+        await self.collection._round_trip()
+        return bool(self._evaluate())
+
+    def next_object(self):
+        results = self._evaluate()
+        return results.popleft() if results else None
+
+    async def explain(self):
+        await self.collection._round_trip()
+        indexed = any(field in self.query and
+                      not isinstance(self.query[field], dict)
+                      for field in INDEXED_FIELDS)
+        plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}
+        if not indexed:
+            plan = {'stage': 'COLLSCAN'}
+        return {'queryPlanner': {'winningPlan': plan}}
+
+
+def project(doc, projection):
+    """Copy `doc` keeping only the fields included by `projection`."""
+    if not projection:
+        return dict(doc)
+    fields = {name for name, included in projection.items() if included}
+    if projection.get('_id', True):
+        fields.add('_id')
+    return {name: value for name, value in doc.items() if name in fields}
+
+
+def matches(doc, query):
+    """Does `doc` satisfy the MongoDB `query` document?"""
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+        elif key == '$and':
+            if not all(matches(doc, clause) for clause in condition):
+                return False
+        elif not _matches_field(doc.get(key), condition):
+            return False
+    return True
+
+
+def _matches_field(value, condition):
+    if isinstance(value, list):
+        return (value == condition or
+                any(_matches_field(item, condition) for item in value))
+    if not isinstance(condition, dict) or not condition:
+        return value == condition
+    for op, operand in condition.items():
+        if op == '$exists':
+            ok = (value is not None) == bool(operand)
+        elif op == '$in':
+            ok = value in operand
+        elif op == '$ne':
+            ok = value != operand
+        elif value is None:
+            ok = False
+        elif op == '$lt':
+            ok = value < operand
+        elif op == '$lte':
+            ok = value <= operand
+        elif op == '$gt':
+            ok = value > operand
+        elif op == '$gte':
+            ok = value >= operand
+        elif op == '$regex':
+            ok = re.search(operand, value) is not None
+        else:
+            raise NotImplementedError(op)
+        if not ok:
+            return False
+    return True
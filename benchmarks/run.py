@@ -0,0 +1,448 @@
+"""
+Load test the readings service against an in-process database.
+
+Each endpoint is measured against a freshly started server process
+that is seeded with the same deterministic data set, so runs with the
+same options are comparable.  The server uses the stand-in database
+from :mod:`benchmarks.fakemongo`; no network access or MongoDB
+server is needed.
+
+Run ``python -m benchmarks.run --help`` from the top of the source
+tree for the available options.  Results can be saved as a baseline
+with ``--save-baseline`` and later runs are compared against it --
+the exit status is 1 if any endpoint regressed by more than the
+``--tolerance`` or failed more requests than before.  A baseline that
+was recorded with different options is not compared against at all;
+the run is refused with an exit status of 3.
+
+"""
+from http import cookies
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import time
+
+from tornado import gen, httpclient, httpserver, ioloop, netutil
+import bson.objectid
+import jwt
+
+from benchmarks import fakemongo
+from readings import app, helpers
+
+
+ENDPOINTS = ['GET /', 'POST /', 'GET /<reading_id>', 'GET /search',
+             'POST /login']
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+EXIT_REGRESSION = 1
+EXIT_CONFIGURATION_MISMATCH = 3
+
+
+class BenchmarkApplication(app.Application):
+    """Application that uses the stand-in database."""
+
+    def __init__(self, client, **kwargs):
+        self.fake_client = client
+        super(BenchmarkApplication, self).__init__(**kwargs)
+
+    @property
+    def mongo(self):
+        if self._mongo is None:
+            self._mongo = helpers.MongoClient(client=self.fake_client,
+                                              metrics=self.metrics)
+        return self._mongo
+
+
+class DataSet(object):
+    """
+    Deterministic users and readings.
+
+    :param int users: number of users to create
+    :param int readings: number of readings per user
+    :param int seed: random seed that the data set is generated from
+
+    The same parameters always generate the same documents so both
+    the server and the load generator can build their own copy.
+
+    """
+
+    def __init__(self, users, readings, seed):
+        rng = random.Random(seed)
+        start = datetime.datetime(2016, 1, 1)
+        self.users, self.readings = [], []
+        for user_index in range(users):
+            user = {'_id': _object_id(rng),
+                    'email': 'user{}@example.com'.format(user_index),
+                    'password': 'password{}'.format(user_index),
+                    'readings_version': 0}
+            self.users.append(user)
+            for reading_index in range(readings):
+                when = start + datetime.timedelta(
+                    seconds=rng.randrange(0, 365 * 86400))
+                reading = {
+                    '_id': _object_id(rng),
+                    'user_id': str(user['_id']),
+                    'title': 'Reading {} of {}'.format(reading_index,
+                                                       user['email']),
+                    'link': 'https://example.com/{}/{}'.format(
+                        user_index, reading_index),
+                    'when': when.replace(microsecond=0)}
+                reading['terms'] = helpers.search_terms(reading['title'],
+                                                        reading['link'])
+                self.readings.append(reading)
+
+    def reading_ids(self, user):
+        user_id = str(user['_id'])
+        return [str(doc['_id']) for doc in self.readings
+                if doc['user_id'] == user_id]
+
+
+def serve(options, port_queue):
+    """Run a seeded server until terminated (in a child process)."""
+    logging.basicConfig(level=logging.WARNING)
+    data = DataSet(options.users, options.readings, options.seed)
+    client = fakemongo.FakeMotorClient(latency=options.mongo_latency)
+    client.readings.users.seed(data.users)
+    client.readings.readings.seed(data.readings)
+
+    application = BenchmarkApplication(client)
+    iol = ioloop.IOLoop.current()
+    for callback in application.runner_callbacks['before_run']:
+        callback(application, iol)
+    for callback in application.runner_callbacks['on_start']:
+        iol.spawn_callback(callback, application, iol)
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    server = httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    port_queue.put(sockets[0].getsockname()[1])
+    iol.start()
+
+
+class Session(object):
+    """Cookies and credentials of a logged in user."""
+
+    def __init__(self, user, reading_ids):
+        self.user = user
+        self.reading_ids = reading_ids
+        self.cookies = cookies.SimpleCookie()
+        self.token = None
+
+    def update_cookies(self, response):
+        for header in response.headers.get_list('Set-Cookie'):
+            self.cookies.load(header)
+
+    @property
+    def cookie_header(self):
+        return '; '.join('{}={}'.format(name, morsel.value)
+                         for name, morsel in self.cookies.items())
+
+
+class LoadGenerator(object):
+    """
+    Drive concurrent requests at a running server.
+
+    :param str base_url: root URL of the server
+    :param DataSet data: data that the server was seeded with
+    :param int concurrency: number of requests to keep in flight
+
+    """
+
+    expected_status = {'GET /': 200, 'POST /': 201,
+                       'GET /<reading_id>': 302, 'GET /search': 200,
+                       'POST /login': 303}
+
+    def __init__(self, base_url, data, concurrency, seed):
+        self.base_url = base_url
+        self.data = data
+        self.concurrency = concurrency
+        self.rng = random.Random(seed)
+        self.client = httpclient.AsyncHTTPClient(
+            force_instance=True, max_clients=concurrency)
+        self.sessions = []
+
+    @gen.coroutine
+    def login(self):
+        for user in self.data.users:
+            session = Session(user, self.data.reading_ids(user))
+            response = yield self.fetch('/login')
+            session.update_cookies(response)
+            session.token = self.make_token(session)
+            response = yield self.login_request(session)
+            if response.code != 303:
+                raise RuntimeError('login failed for {}: {}'.format(
+                    user['email'], response.code))
+            session.update_cookies(response)
+            self.sessions.append(session)
+
+    def make_token(self, session):
+        now = int(time.time())
+        token = jwt.encode({'iss': self.base_url + '/login', 'nbf': now - 5,
+                            'exp': now + 3600,
+                            'csrf': session.cookies['csrf'].value},
+                           session.user['password'], algorithm='HS256')
+        return token.decode('ASCII') if isinstance(token, bytes) else token
+
+    def fetch(self, path, session=None, **kwargs):
+        headers = kwargs.pop('headers', {})
+        if session is not None:
+            headers['Cookie'] = session.cookie_header
+        return self.client.fetch(self.base_url + path, headers=headers,
+                                 follow_redirects=False, raise_error=False,
+                                 **kwargs)
+
+    def login_request(self, session):
+        return self.fetch(
+            '/login', session, method='POST',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps({'email': session.user['email'],
+                             'token': session.token}))
+
+    def request(self, endpoint):
+        session = self.rng.choice(self.sessions)
+        if endpoint == 'GET /':
+            return self.fetch('/', session, headers={
+                'Accept': 'application/json',
+                'X-Requested-With': 'XMLHttpRequest'})
+        if endpoint == 'POST /':
+            return self.fetch('/', session, method='POST', headers={
+                'Content-Type': 'application/json',
+                'Origin': self.base_url},
+                body=json.dumps({'title': 'benchmark',
+                                 'url': 'https://example.com/benchmark'}))
+        if endpoint == 'GET /<reading_id>':
+            return self.fetch('/' + self.rng.choice(session.reading_ids),
+                              session)
+        if endpoint == 'GET /search':
+            return self.fetch('/search?q=reading+{}'.format(
+                self.rng.randrange(10)), session)
+        if endpoint == 'POST /login':
+            return self.login_request(session)
+        raise ValueError(endpoint)
+
+    @gen.coroutine
+    def run(self, endpoint, count):
+        """
+        Send `count` requests to `endpoint`.
+
+        :returns: ``(latencies, errors, elapsed)`` where `latencies`
+            is a list of seconds per request
+
+        """
+        remaining = [count]
+        latencies, errors = [], [0]
+        expected = self.expected_status[endpoint]
+
+        @gen.coroutine
+        def worker():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                start = time.perf_counter()
+                response = yield self.request(endpoint)
+                latencies.append(time.perf_counter() - start)
+                if response.code != expected:
+                    errors[0] += 1
+
+        start = time.perf_counter()
+        yield [worker() for _ in range(self.concurrency)]
+        raise gen.Return((latencies, errors[0], time.perf_counter() - start))
+
+
+def measure(endpoint, options):
+    """Measure `endpoint` against a new server process."""
+    context = multiprocessing.get_context('spawn')
+    port_queue = context.Queue()
+    server = context.Process(target=serve, args=(options, port_queue),
+                             daemon=True)
+    server.start()
+    try:
+        port = port_queue.get(timeout=60)
+        iol = ioloop.IOLoop()
+        iol.make_current()
+        data = DataSet(options.users, options.readings, options.seed)
+        generator = LoadGenerator('http://127.0.0.1:{}'.format(port), data,
+                                  options.concurrency, options.seed)
+        iol.run_sync(generator.login)
+        iol.run_sync(lambda: generator.run(endpoint, options.warmup))
+        latencies, errors, elapsed = iol.run_sync(
+            lambda: generator.run(endpoint, options.requests))
+        peak_rss = read_peak_rss(server.pid)
+        generator.client.close()
+        iol.close(all_fds=True)
+    finally:
+        server.terminate()
+        server.join()
+
+    latencies.sort()
+    return {'requests': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / elapsed,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'peak_rss_kb': peak_rss}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100.0 * len(sorted_values))), 1)
+    return sorted_values[rank - 1]
+
+
+def read_peak_rss(pid):
+    """Peak resident set size of `pid` in kilobytes (Linux only)."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare `results` with the `baseline` results.
+
+    Timings and memory use may be up to `tolerance` worse than the
+    baseline, but any increase in failed requests is a regression.
+
+    :returns: list of human-readable regressions
+
+    """
+    regressions = []
+    for endpoint, current in sorted(results.items()):
+        previous = baseline.get(endpoint)
+        if previous is None:
+            continue
+        if current['errors'] > previous['errors']:
+            regressions.append('{}: errors {} > {}'.format(
+                endpoint, current['errors'], previous['errors']))
+        if current['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append('{}: throughput {:.1f}/s < {:.1f}/s'.format(
+                endpoint, current['throughput'], previous['throughput']))
+        for key in ('p50', 'p95', 'p99'):
+            if current[key] > previous[key] * (1 + tolerance):
+                regressions.append('{}: {} {:.2f}ms > {:.2f}ms'.format(
+                    endpoint, key, current[key] * 1000,
+                    previous[key] * 1000))
+        if (current['peak_rss_kb'] and previous['peak_rss_kb'] and
+                current['peak_rss_kb'] >
+                previous['peak_rss_kb'] * (1 + tolerance)):
+            regressions.append('{}: peak RSS {}kB > {}kB'.format(
+                endpoint, current['peak_rss_kb'], previous['peak_rss_kb']))
+    return regressions
+
+
+def report(results, out=sys.stdout):
+    out.write('{:<20} {:>8} {:>6} {:>10} {:>9} {:>9} {:>9} {:>10}\n'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms', 'rss kB'))
+    for endpoint, result in results.items():
+        out.write('{:<20} {:>8} {:>6} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f} '
+                  '{:>10}\n'.format(endpoint, result['requests'],
+                                    result['errors'], result['throughput'],
+                                    result['p50'] * 1000,
+                                    result['p95'] * 1000,
+                                    result['p99'] * 1000,
+                                    result['peak_rss_kb'] or '-'))
+
+
+def get_configuration(options):
+    return {'users': options.users, 'readings': options.readings,
+            'concurrency': options.concurrency,
+            'requests': options.requests, 'warmup': options.warmup,
+            'mongo_latency': options.mongo_latency, 'seed': options.seed}
+
+
+def _object_id(rng):
+    return bson.objectid.ObjectId(bytes(rng.getrandbits(8)
+                                        for _ in range(12)))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Load test the readings service in-process.')
+    parser.add_argument('--endpoint', action='append', choices=ENDPOINTS,
+                        help='endpoint to measure.  Repeat to measure '
+                             'several.  Defaults to all endpoints.')
+    parser.add_argument('--users', type=int, default=10,
+                        help='number of users to seed (default: 10)')
+    parser.add_argument('--readings', type=int, default=500,
+                        help='readings per user (default: 500)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='requests in flight (default: 16)')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='measured requests per endpoint '
+                             '(default: 2000)')
+    parser.add_argument('--warmup', type=int, default=200,
+                        help='unmeasured requests sent first '
+                             '(default: 200)')
+    parser.add_argument('--mongo-latency', type=float, default=0.0,
+                        help='simulated database round trip in seconds '
+                             '(default: 0)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='seed for the data set and request mix')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline results file (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fraction that a measurement may be worse '
+                             'than the baseline (default: 0.1)')
+    parser.add_argument('--output', help='also write the results as JSON')
+    options = parser.parse_args(args)
+    logging.basicConfig(level=logging.WARNING)
+
+    configuration = get_configuration(options)
+    baseline = None
+    if not options.save_baseline and os.path.exists(options.baseline):
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['configuration'] != configuration:
+            sys.stderr.write(
+                'refusing to compare with {}: it was recorded with {!r} '
+                'but this run uses {!r}.  Rerun with the same options or '
+                'record a new baseline with --save-baseline.\n'.format(
+                    options.baseline, baseline['configuration'],
+                    configuration))
+            sys.exit(EXIT_CONFIGURATION_MISMATCH)
+
+    results = {}
+    for endpoint in options.endpoint or ENDPOINTS:
+        sys.stderr.write('measuring {}\n'.format(endpoint))
+        results[endpoint] = measure(endpoint, options)
+    report(results)
+
+    document = {'configuration': configuration,
+                'environment': {'python': platform.python_version(),
+                                'platform': platform.platform(),
+                                'cpus': os.cpu_count()},
+                'results': results}
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(document, output, indent=2, sort_keys=True)
+
+    status = 0
+    if options.save_baseline:
+        with open(options.baseline, 'w') as output:
+            json.dump(document, output, indent=2, sort_keys=True)
+        sys.stderr.write('saved baseline to {}\n'.format(options.baseline))
+    elif baseline is not None:
+        regressions = compare(results, baseline['results'],
+                              options.tolerance)
+        for regression in regressions:
+            sys.stderr.write('REGRESSION {}\n'.format(regression))
+        status = EXIT_REGRESSION if regressions else 0
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
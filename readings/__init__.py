@@ -1,2 +1,7 @@
+import time
+
+import_time = time.monotonic()
+"""When the package was first imported, for measuring startup."""
+
 version_info = (0, 0, 0)
 version = '.'.join(str(v) for v in version_info)
@@ -1,14 +1,29 @@
 from urllib import parse
+import argparse
+import calendar
+import datetime
+import json
 import logging
+import logging.config
 import os
-import pkg_resources
+import struct
+import tempfile
+import time
 
 from sprockets.mixins.mediatype import content, transcoders
-from tornado import web
-import sprockets.http
+from tornado import concurrent, httputil, ioloop, web
+from tornado.log import access_log
+import pymongo.read_preferences
 import sprockets.mixins.mediatype.handlers
 
-from readings import handlers, helpers
+import readings
+from readings import (assets, cache, compression, events, handlers, helpers,
+                      metrics, runner, timing)
+
+try:
+    import umsgpack
+except ImportError:
+    umsgpack = None
 
 
 class Application(web.Application):
@@ -20,15 +35,28 @@ class Application(web.Application):
         else:
             kwargs['cookie_secret'] = os.urandom(256)
 
-        kwargs.setdefault(
-            'static_path',
-            pkg_resources.resource_filename('readings', 'static'))
+        kwargs.setdefault('static_path', os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'static'))
         kwargs.setdefault('static_url_path', '/static')
+        kwargs.setdefault('static_handler_class', assets.StaticAssetHandler)
+        if 'static_handler_args' not in kwargs:
+            kwargs['static_handler_args'] = {
+                'manifest': assets.AssetManifest(
+                    kwargs['static_path'],
+                    kwargs.get('static_url_prefix', '/static/'),
+                    cache_dir=get_static_cache_directory())}
         kwargs.setdefault('login_url', '/login')
         super(Application, self).__init__([
                 web.url(r'/', handlers.ReadingsHandler, name='readings'),
                 web.url(r'/login', handlers.LoginHandler, name='login'),
-                web.url(r'/logout', handlers.LogoutHandler),
+                web.url(r'/logout', handlers.LogoutHandler, name='logout'),
+                web.url(r'/metrics', handlers.MetricsHandler, name='metrics'),
+                web.url(r'/healthz', handlers.HealthHandler, name='healthz'),
+                web.url(r'/readyz', handlers.ReadinessHandler, name='readyz'),
+                web.url(r'/events', handlers.EventsHandler, name='events'),
+                web.url(r'/search', handlers.SearchHandler, name='search'),
+                web.url(r'/export', handlers.ExportHandler, name='export'),
+                web.url(r'/import', handlers.ImportHandler, name='import'),
                 web.url(r'/(?P<reading_id>.*)', handlers.ReadingHandler,
                         name='reading'),
             ], **kwargs)
@@ -36,15 +64,336 @@ class Application(web.Application):
                                          encoding='utf-8')
         content.add_transcoder(self, transcoders.JSONTranscoder())
         content.add_transcoder(self, FormUrlEncodedTranscoder())
+        if umsgpack is not None:
+            content.add_transcoder(self, MsgPackTranscoder())
+        self.add_transform(compression.CompressionTransform)
 
         self._mongo = None
+        self._mongo_pid = None
+        self.requests_in_flight = 0
+        self.ready = False
+        self.user_cache = cache.LRUCache(
+            max_size=int(os.environ.get('USER_CACHE_SIZE', '10000')),
+            ttl=float(os.environ.get('USER_CACHE_TTL', '60')))
+        self.link_cache = cache.LRUCache(
+            max_size=int(os.environ.get('LINK_CACHE_SIZE', '10000')),
+            ttl=float(os.environ.get('LINK_CACHE_TTL', '3600')))
+        self.list_cache = cache.LRUCache(
+            max_size=int(os.environ.get('LIST_CACHE_SIZE', '1000')),
+            ttl=float(os.environ.get('LIST_CACHE_TTL', '300')),
+            max_bytes=int(os.environ.get('LIST_CACHE_BYTES',
+                                         str(64 * 1024 * 1024))),
+            weigh=handlers.RenderedList.weigh)
+        self.primary_window = get_primary_window()
+        self.max_lag = get_max_lag()
+        self.primary_pins = cache.LRUCache(
+            max_size=int(os.environ.get('USER_CACHE_SIZE', '10000')),
+            ttl=self.primary_window)
+        self.events = events.EventBroker()
+        self.metrics = metrics.Registry()
+        self.route_names = {spec.handler_class: name
+                            for name, spec in self.named_handlers.items()}
+        self.loop_lag_monitor = metrics.LoopLagMonitor(self.metrics)
+        self.profiler = timing.Profiler(
+            sample_rate=int(os.environ.get('PROFILE_SAMPLE_RATE', '0')),
+            directory=os.environ.get(
+                'PROFILE_DIRECTORY',
+                os.path.join(tempfile.gettempdir(), 'readings-profiles')),
+            keep=int(os.environ.get('PROFILE_KEEP', '20')))
+        self.runner_callbacks = {'before_run': [self.warm_up_database,
+                                                self.prepare_database,
+                                                self.start_monitoring],
+                                 'on_start': [self.mark_ready],
+                                 'shutdown': [self.mark_not_ready,
+                                              self.close_event_streams,
+                                              self.stop_monitoring,
+                                              self.drain_requests]}
+
+    def invalidate_user(self, user_id):
+        """Discard any cached information about `user_id`."""
+        self.user_cache.invalidate(str(user_id))
+
+    def remember_link(self, user_id, reading_id, link):
+        """Cache the external `link` of a reading for redirects."""
+        self.link_cache.set((str(user_id), str(reading_id)), link)
+
+    def forget_link(self, user_id, reading_id):
+        """Discard the cached link of a reading that was removed."""
+        self.link_cache.invalidate((str(user_id), str(reading_id)))
+
+    def warm_up_database(self, app, iol):
+        """
+        Open database connections before accepting requests.
+
+        This is registered as a *before_run* callback and does nothing
+        unless :envvar:`MONGODB_WARM_UP` is set.  The server is pinged
+        over :envvar:`MONGODB_MIN_POOL_SIZE` connections (or one) so
+        that the first requests do not pay for connecting.  A failure
+        is logged and the service starts anyway -- :http:get:`/readyz`
+        reports whether the database is reachable.
+
+        """
+        if os.environ.get('MONGODB_WARM_UP', '').lower() not in (
+                '1', 'true', 'yes', 'on'):
+            return
+
+        connections = int(os.environ.get('MONGODB_MIN_POOL_SIZE') or '1')
+        start = time.monotonic()
+        try:
+            iol.run_sync(lambda: self.mongo.warm_up(connections))
+        except Exception:
+            self.logger.exception('failed to warm up database connections')
+            return
+        self.logger.info('opened %d database connections in %.3fs',
+                         connections, time.monotonic() - start)
+
+    def mark_ready(self, app, iol):
+        """
+        Start reporting that requests can be served.
+
+        This is registered as an *on_start* callback so it runs once
+        the *before_run* callbacks have completed and the IOLoop is
+        running.  The time since the :mod:`readings` package was first
+        imported is logged and recorded as a metric.
+
+        """
+        self.ready = True
+        elapsed = time.monotonic() - readings.import_time
+        self.metrics.gauge(
+            'readings_startup_seconds',
+            'Time from importing the service to serving requests.').set(
+                (), elapsed)
+        self.logger.info('ready to serve requests %.3fs after starting',
+                         elapsed)
+
+    def mark_not_ready(self, app):
+        """
+        Report that the service is stopping.
+
+        This is registered as the first *shutdown* callback so that
+        :http:get:`/readyz` fails while in-flight requests drain.
+
+        """
+        self.ready = False
+
+    def pin_to_primary(self, user_id):
+        """
+        Read `user_id`'s data from the primary for a while.
+
+        This is called after the user changes something so that their
+        next reads see the change even if the secondaries lag behind.
+        The pin lasts for :attr:`primary_window` seconds and is only
+        recorded when reads are sent elsewhere.
+
+        """
+        if self.primary_window:
+            self.primary_pins.set(str(user_id), True)
+
+    def is_pinned_to_primary(self, user_id):
+        return str(user_id) in self.primary_pins
+
+    def prepare_database(self, app, iol):
+        """
+        Reconcile the database indexes before accepting requests.
+
+        This is registered as a *before_run* callback.  Indexes declared
+        in :data:`readings.helpers.INDEXES` are created if necessary.
+        Set :envvar:`MONGODB_VERIFY_INDEXES` to ``log`` to explain each
+        canonical query at startup and log the ones that are not backed
+        by an index, or to ``fail`` to refuse to start instead.
+
+        """
+        verify_mode = os.environ.get('MONGODB_VERIFY_INDEXES', '').lower()
+        try:
+            iol.run_sync(self.mongo.ensure_indexes)
+        except Exception:
+            self.logger.exception('failed to ensure database indexes')
+            if verify_mode == 'fail':
+                raise
+
+        if verify_mode in ('log', 'fail'):
+            failures = iol.run_sync(self.mongo.verify_indexes)
+            if failures and verify_mode == 'fail':
+                raise RuntimeError('{} queries are not index-backed'.format(
+                    len(failures)))
+
+        if os.environ.get('SEARCH_BACKFILL'):
+            iol.run_sync(self.backfill_search_terms)
+
+    async def backfill_search_terms(self):
+        """
+        Add search terms to readings that were saved without them.
+
+        Readings that were added before search was available cannot be
+        found until this has been run.  It is run at startup when
+        :envvar:`SEARCH_BACKFILL` is set and scans the entire readings
+        collection so it should be unset afterwards.
+
+        """
+        updated = 0
+
+        async def on_batch(docs):
+            nonlocal updated
+            for doc in docs:
+                updated += await self.mongo.update(
+                    'readings', {'_id': doc['_id']},
+                    {'terms': helpers.search_terms(doc['title'],
+                                                   doc['link'])})
+
+        await self.mongo.find(
+            'readings', {'terms': {'$exists': False}},
+            projection={'title': True, 'link': True}, batch_size=500,
+            on_batch=on_batch)
+        self.logger.info('added search terms to %d readings', updated)
+
+    def start_monitoring(self, app, iol):
+        """Start measuring event loop lag in this process."""
+        self.loop_lag_monitor.start(iol)
+
+    def stop_monitoring(self, app):
+        """
+        Stop measuring event loop lag.
+
+        This is registered as a *shutdown* callback so that the
+        monitor's repeating timeout does not keep the IOLoop from
+        stopping once the in-flight requests have drained.
+
+        """
+        self.loop_lag_monitor.stop(ioloop.IOLoop.current())
+
+    def collect_metrics(self):
+        """
+        Render the metrics in the Prometheus text format.
+
+        Connection pool and cache usage are sampled when this is
+        called.
+
+        """
+        gauge = self.metrics.gauge(
+            'readings_mongo_pool', 'Database connection pool usage.',
+            ('measure',))
+        for measure, value in sorted(self.mongo.pool_stats().items()):
+            if value is not None:
+                gauge.set((measure,), value)
+        gauge = self.metrics.gauge(
+            'readings_cache', 'In-process cache usage.', ('cache', 'measure'))
+        for name, lru in (('user', self.user_cache),
+                          ('link', self.link_cache),
+                          ('list', self.list_cache)):
+            for measure, value in sorted(lru.stats().items()):
+                gauge.set((name, measure), value)
+        return self.metrics.render()
+
+    def close_event_streams(self, app):
+        """
+        End the open event streams.
+
+        This is registered as a *shutdown* callback so that the long
+        lived event streams do not hold up :meth:`drain_requests`.
+
+        """
+        self.events.close()
+
+    def start_request(self, server_conn, request_conn):
+        return _RequestCounter(self, super(Application, self).start_request(
+            server_conn, request_conn))
+
+    def log_request(self, handler):
+        """
+        Record request metrics and write the access log.
+
+        Each request is logged as a single JSON object that includes
+        the phase timings of handlers that record them (see
+        :class:`readings.timing.TimingMixin`).
+
+        """
+        self.requests_in_flight = max(self.requests_in_flight - 1, 0)
+        route = self.route_names.get(handler.__class__)
+        if route is None:
+            route = ('static'
+                     if isinstance(handler, (assets.StaticAssetHandler,
+                                             web.StaticFileHandler))
+                     else 'other')
+        labels = (route, str(handler.get_status()))
+        self.metrics.counter(
+            'readings_requests_total', 'Requests that were processed.',
+            ('route', 'status')).inc(labels)
+        self.metrics.histogram(
+            'readings_request_seconds', 'Time taken to process requests.',
+            ('route', 'status')).observe(labels,
+                                         handler.request.request_time())
+
+        status = handler.get_status()
+        if status < 400:
+            log_method = access_log.info
+        elif status < 500:
+            log_method = access_log.warning
+        else:
+            log_method = access_log.error
+        timings = getattr(handler, 'timings', None)
+        log_method('%s', json.dumps({
+            'method': handler.request.method,
+            'path': handler.request.path,
+            'route': route,
+            'status': status,
+            'remote_ip': handler.request.remote_ip,
+            'duration_ms': round(handler.request.request_time() * 1000, 3),
+            'phases': timings.as_dict() if timings is not None else {},
+        }, sort_keys=True))
+
+    def drain_requests(self, app):
+        """
+        Wait for in-flight requests to complete.
+
+        This is registered as a *shutdown* callback.  It returns a future
+        that resolves once every in-flight request has finished or after
+        :envvar:`SHUTDOWN_TIMEOUT` seconds (10 by default).
+
+        """
+        iol = ioloop.IOLoop.current()
+        deadline = iol.time() + float(os.environ.get('SHUTDOWN_TIMEOUT', '10'))
+        future = concurrent.Future()
+
+        def check():
+            if not self.requests_in_flight:
+                future.set_result(True)
+            elif iol.time() >= deadline:
+                self.logger.warning('abandoning %d in-flight requests',
+                                    self.requests_in_flight)
+                future.set_result(False)
+            else:
+                iol.call_later(0.1, check)
+
+        self.logger.info('draining %d in-flight requests',
+                         self.requests_in_flight)
+        check()
+        return future
 
     @property
     def mongo(self):
+        # the client is created lazily in each process since it cannot
+        # be shared with processes that are forked after it connects
+        if self._mongo_pid != os.getpid():
+            self._mongo = None
         if self._mongo is None:
+            self._mongo_pid = os.getpid()
+            options = {
+                'operation_timeout': float(
+                    os.environ.get('MONGODB_OPERATION_TIMEOUT', '10')),
+                'pool_options': get_pool_options(),
+                'metrics': self.metrics,
+                'write_concern': get_write_concern(),
+                'read_preference': get_read_preference(),
+                'insert_options': {
+                    'max_delay': float(
+                        os.environ.get('MONGODB_INSERT_DELAY', '0.002')),
+                    'max_size': int(
+                        os.environ.get('MONGODB_INSERT_BATCH_SIZE', '100')),
+                },
+            }
             try:
                 self._mongo = helpers.MongoClient(
-                    url=os.environ['MONGODB_URL'])
+                    url=os.environ['MONGODB_URL'], **options)
             except KeyError:
                 self._mongo = helpers.MongoClient(
                     user=os.environ.get('MONGODB_USER', 'readings'),
@@ -52,10 +401,181 @@ class Application(web.Application):
                     host=os.environ.get('MONGODB_HOST', '127.0.0.1'),
                     port=int(os.environ.get('MONGODB_PORT', '27017')),
                     database=os.environ.get('MONGODB_DATABASE', 'readings'),
-                )
+                    **options)
         return self._mongo
 
 
+POOL_OPTIONS = [
+    ('MONGODB_MAX_POOL_SIZE', 'maxPoolSize', int),
+    ('MONGODB_MIN_POOL_SIZE', 'minPoolSize', int),
+    ('MONGODB_MAX_IDLE_TIME', 'maxIdleTimeMS', float),
+    ('MONGODB_WAIT_QUEUE_TIMEOUT', 'waitQueueTimeoutMS', float),
+    ('MONGODB_WAIT_QUEUE_MULTIPLE', 'waitQueueMultiple', int),
+    ('MONGODB_SERVER_SELECTION_TIMEOUT', 'serverSelectionTimeoutMS', float),
+    ('MONGODB_CONNECT_TIMEOUT', 'connectTimeoutMS', float),
+    ('MONGODB_SOCKET_TIMEOUT', 'socketTimeoutMS', float),
+]
+"""Environment variables that configure the driver's connection pool."""
+
+
+def get_pool_options():
+    """
+    Build the driver's connection pool options from the environment.
+
+    Only the variables in :data:`POOL_OPTIONS` that are set are passed
+    along so the driver defaults apply otherwise.  Durations are given
+    in seconds and converted to the milliseconds that the driver uses.
+
+    """
+    options = {}
+    for env_name, option, cast in POOL_OPTIONS:
+        value = os.environ.get(env_name)
+        if value:
+            value = cast(value)
+            if option.endswith('MS'):
+                value = int(value * 1000)
+            options[option] = value
+    return options
+
+
+def get_write_concern():
+    """
+    Build the write concern options from the environment.
+
+    A numeric :envvar:`MONGODB_WRITE_CONCERN` is the number of servers
+    that must acknowledge a write, anything else is a tag set name
+    such as ``majority``.  :envvar:`MONGODB_WRITE_TIMEOUT` is given in
+    seconds and converted to the milliseconds that the driver uses.
+    Options that are not set are left to the server default.
+
+    """
+    options = {}
+    w = os.environ.get('MONGODB_WRITE_CONCERN')
+    if w:
+        options['w'] = int(w) if w.isdigit() else w
+    journal = os.environ.get('MONGODB_JOURNAL')
+    if journal:
+        options['j'] = journal.lower() in ('1', 'true', 'yes', 'on')
+    wtimeout = os.environ.get('MONGODB_WRITE_TIMEOUT')
+    if wtimeout:
+        options['wtimeout'] = int(float(wtimeout) * 1000)
+    return options
+
+
+READ_PREFERENCES = {
+    'primary': pymongo.read_preferences.Primary,
+    'primarypreferred': pymongo.read_preferences.PrimaryPreferred,
+    'secondary': pymongo.read_preferences.Secondary,
+    'secondarypreferred': pymongo.read_preferences.SecondaryPreferred,
+    'nearest': pymongo.read_preferences.Nearest,
+}
+"""Read preference modes by lower-cased name."""
+
+DEFAULT_PRIMARY_WINDOW = 90.0
+"""Seconds that reads stay on the primary after a write by default."""
+
+
+def get_read_preference():
+    """
+    Build the read preference from the environment.
+
+    :envvar:`MONGODB_READ_PREFERENCE` names the mode, such as
+    ``secondaryPreferred``, and :envvar:`MONGODB_MAX_STALENESS` is the
+    number of seconds that a secondary may lag behind the primary and
+    still be read from.  The driver requires at least 90 seconds.
+
+    :returns: a :mod:`pymongo.read_preferences` instance or
+        :data:`None` to read from the primary
+    :raises ValueError: if the mode is not known
+
+    """
+    mode = os.environ.get('MONGODB_READ_PREFERENCE')
+    if not mode:
+        return None
+    try:
+        read_preference = READ_PREFERENCES[mode.lower()]
+    except KeyError:
+        raise ValueError('unknown read preference {!r}'.format(mode))
+    if read_preference is pymongo.read_preferences.Primary:
+        return read_preference()
+    max_staleness = os.environ.get('MONGODB_MAX_STALENESS')
+    return read_preference(
+        max_staleness=int(float(max_staleness)) if max_staleness else -1)
+
+
+def get_primary_window():
+    """
+    Return how long reads stay on the primary after a write.
+
+    :envvar:`MONGODB_PRIMARY_WINDOW` is given in seconds and defaults
+    to :envvar:`MONGODB_MAX_STALENESS` or :data:`DEFAULT_PRIMARY_WINDOW`.
+    Reads are never pinned when they go to the primary anyway.
+
+    """
+    read_preference = get_read_preference()
+    if (read_preference is None or
+            isinstance(read_preference, pymongo.read_preferences.Primary)):
+        return 0.0
+    window = (os.environ.get('MONGODB_PRIMARY_WINDOW') or
+              os.environ.get('MONGODB_MAX_STALENESS'))
+    return float(window) if window else DEFAULT_PRIMARY_WINDOW
+
+
+def get_static_cache_directory():
+    """
+    Return where compressed static assets are kept between runs.
+
+    :envvar:`STATIC_CACHE_DIRECTORY` defaults to a directory in the
+    temporary directory that is named after the current user.  An
+    empty value disables the cache.
+
+    """
+    directory = os.environ.get(
+        'STATIC_CACHE_DIRECTORY',
+        os.path.join(tempfile.gettempdir(),
+                     'readings-static-{}'.format(os.getuid())))
+    return directory or None
+
+
+def get_max_lag():
+    """
+    Return how many seconds a read may lag behind the primary.
+
+    This is :envvar:`MONGODB_MAX_STALENESS` when reads may go to a
+    secondary, or :data:`DEFAULT_PRIMARY_WINDOW` if the staleness is
+    not limited, and zero when reads go to the primary.
+
+    """
+    read_preference = get_read_preference()
+    if (read_preference is None or
+            isinstance(read_preference, pymongo.read_preferences.Primary)):
+        return 0.0
+    if read_preference.max_staleness > 0:
+        return float(read_preference.max_staleness)
+    return DEFAULT_PRIMARY_WINDOW
+
+
+class _RequestCounter(httputil.HTTPMessageDelegate):
+    """Counts requests from when their headers arrive."""
+
+    def __init__(self, application, delegate):
+        self.application = application
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        self.application.requests_in_flight += 1
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        return self.delegate.finish()
+
+    def on_connection_close(self):
+        return self.delegate.on_connection_close()
+
+
 class FormUrlEncodedTranscoder(
         sprockets.mixins.mediatype.handlers.TextContentHandler):
 
@@ -82,9 +602,50 @@ class FormUrlEncodedTranscoder(
         return body
 
 
-def main():
+class MsgPackTranscoder(transcoders.MsgPackTranscoder):
+    """
+    MessagePack transcoder that encodes datetimes natively.
+
+    Datetimes are packed as the MessagePack timestamp extension type
+    instead of ISO-8601 strings.  Naive datetimes are taken to be UTC.
+
+    """
+
+    TIMESTAMP_TYPE = -1
+
+    def normalize_datum(self, datum):
+        if isinstance(datum, datetime.datetime):
+            return umsgpack.Ext(self.TIMESTAMP_TYPE, pack_timestamp(datum))
+        return super(MsgPackTranscoder, self).normalize_datum(datum)
+
+
+def pack_timestamp(when):
+    """Pack `when` in the smallest MessagePack timestamp format."""
+    if when.tzinfo is not None:
+        when = when.astimezone(datetime.timezone.utc)
+    seconds = calendar.timegm(when.timetuple())
+    nanoseconds = when.microsecond * 1000
+    if seconds >> 34 == 0:
+        value = nanoseconds << 34 | seconds
+        if value >> 32 == 0:
+            return struct.pack('>I', value)
+        return struct.pack('>Q', value)
+    return struct.pack('>Iq', nanoseconds, seconds)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run the readings service.')
+    parser.add_argument('--port', type=int,
+                        default=int(os.environ.get('PORT', '8000')),
+                        help='port number to listen on (env: PORT)')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('WORKERS', '1')),
+                        help='number of worker processes to pre-fork, or '
+                             'zero for one per CPU (env: WORKERS)')
+    options = parser.parse_args(args)
+
     root_level = 'INFO' if os.environ.get('DEBUG', None) is None else 'DEBUG'
-    sprockets.http.run(Application, log_config={
+    logging.config.dictConfig({
         'version': 1,
         'disable_existing_loggers': False,
         'incremental': False,
@@ -101,6 +662,10 @@ def main():
         'loggers': {'readings': {'level': 'DEBUG'}},
     })
 
+    debug = int(os.environ.get('DEBUG', '0')) != 0
+    server = runner.Runner(Application(debug=debug))
+    server.run(options.port, options.workers)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,359 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+import tempfile
+import time
+
+from tornado import web
+
+from readings import compression
+
+
+CONTENT_TYPES = {
+    '.css': 'text/css',
+    '.html': 'text/html',
+    '.js': 'application/javascript',
+    '.woff': 'font/woff',
+}
+"""Content types that :mod:`mimetypes` does not reliably know."""
+
+TEXT_TYPES = frozenset(['application/javascript', 'text/css', 'text/html'])
+"""Content types that are compressed and may refer to other assets."""
+
+MIN_COMPRESSED_SIZE = 512
+"""Assets smaller than this many bytes are not worth compressing."""
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_MODULE_REFERENCE = re.compile(r'"([\w./-]+)"')
+
+
+class Asset(object):
+    """
+    A static file prepared for serving.
+
+    :param str path: location relative to the static directory
+    :param bytes content: the file content after references to other
+        assets have been rewritten
+    :param str content_type: the MIME type of `content`
+    :param load_variant: optional callable that returns an encoding of
+        `content` (see :meth:`AssetManifest.load_variant`)
+
+    :attr:`public_path` contains a digest of the content for every
+    asset other than HTML documents, which are entry points that are
+    linked to by name.  The ``gzip`` and ``br`` (if :mod:`brotli` is
+    installed) encodings of text assets are computed up front.
+
+    """
+
+    def __init__(self, path, content, content_type, load_variant=None):
+        self.path = path
+        self.content_type = content_type
+        content_hash = hashlib.sha256(content).hexdigest()
+        self.digest = content_hash[:16]
+        if content_type == 'text/html':
+            self.public_path = path
+        else:
+            base, ext = posixpath.splitext(path)
+            self.public_path = '{}.{}{}'.format(base, self.digest, ext)
+
+        if load_variant is None:
+            def load_variant(name, content, compress, decompress):
+                return compress()
+
+        self.variants = {'identity': content}
+        if content_type in TEXT_TYPES and len(content) >= MIN_COMPRESSED_SIZE:
+            self.variants['gzip'] = load_variant(
+                content_hash + '.gz', content,
+                lambda: gzip.compress(content, compresslevel=9),
+                gzip.decompress)
+            if compression.brotli is not None:
+                self.variants['br'] = load_variant(
+                    content_hash + '.br', content,
+                    lambda: compression.brotli.compress(
+                        content, mode=compression.brotli.MODE_TEXT),
+                    compression.brotli.decompress)
+            for encoding, body in list(self.variants.items()):
+                if len(body) >= len(content) and encoding != 'identity':
+                    del self.variants[encoding]
+
+    def select(self, accept_encoding):
+        """
+        Choose the smallest variant that the client accepts.
+
+        :param str accept_encoding: the request's
+            :http:header:`Accept-Encoding` header
+        :returns: a ``(encoding, body)`` tuple
+
+        """
+        weights = compression.parse_accept_encoding(accept_encoding)
+        acceptable = [(len(body), encoding)
+                      for encoding, body in self.variants.items()
+                      if encoding == 'identity' or
+                      weights.get(encoding, weights.get('*', 0.0)) > 0.0]
+        _, encoding = min(acceptable)
+        return encoding, self.variants[encoding]
+
+    def etag(self, encoding):
+        return '"{}-{}"'.format(self.digest, encoding)
+
+
+class AssetManifest(object):
+    """
+    Every static asset, fingerprinted and compressed.
+
+    :param str root: the static directory
+    :param str prefix: the URL path that static assets are served from
+    :param str cache_dir: optional directory that compressed encodings
+        are kept in between runs, see :meth:`load_variant`.  It is
+        created if necessary and only used if it belongs to the
+        current user and nobody else can write to it.
+
+    Text assets are rewritten so that references to other assets use
+    their fingerprinted names.  Absolute references such as
+    ``/static/style.css`` are rewritten anywhere, and quoted RequireJS
+    module ids such as ``"lib/jquery-3.1.0.min"`` are rewritten in
+    scripts.  Module ids are resolved relative to the directory that
+    contains the script, which is where ``data-main`` puts the
+    RequireJS base URL.  Assets are processed after the assets that
+    they refer to so a change to any file changes the fingerprints of
+    everything that depends on it.
+
+    The assets are prepared when the manifest is first used rather
+    than when it is created.
+
+    """
+
+    def __init__(self, root, prefix='/static/', cache_dir=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.root = root
+        self.prefix = prefix
+        self.cache_dir = cache_dir
+        self._use_cache = False
+        self._absolute_reference = re.compile(
+            re.escape(prefix) + r'([\w./-]+)')
+        self._assets = None
+        self._public = None
+
+    @property
+    def assets(self):
+        """Every :class:`Asset` keyed by its original path."""
+        if self._assets is None:
+            self._build()
+        return self._assets
+
+    @property
+    def public(self):
+        """Every :class:`Asset` keyed by its public path."""
+        if self._public is None:
+            self._build()
+        return self._public
+
+    def find(self, path):
+        """Find the asset served at `path` by either of its names."""
+        return self.public.get(path) or self.assets.get(path)
+
+    def public_path(self, path):
+        """Return the name that `path` is served by."""
+        asset = self.assets.get(path)
+        return path if asset is None else asset.public_path
+
+    def load_variant(self, name, content, compress, decompress):
+        """
+        Load a compressed encoding from disk, compressing it if necessary.
+
+        :param str name: file name that includes the hash of the content
+        :param bytes content: the content that is encoded
+        :param compress: callable that returns the compressed content
+        :param decompress: callable that decodes a compressed body
+        :rtype: bytes
+
+        Encodings are named after the content that they were made from
+        and a cached encoding is only used if it decodes to `content`,
+        so stale or tampered files are never served.  Without a usable
+        :attr:`cache_dir` the content is always compressed.  Failing to
+        read or write the cache is logged and otherwise ignored.
+
+        """
+        if not self._use_cache:
+            return compress()
+
+        cache_path = os.path.join(self.cache_dir, name)
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                body = cache_file.read()
+            if decompress(body) == content:
+                return body
+            self.logger.warning('ignoring %s since it does not match %s',
+                                cache_path, name)
+        except FileNotFoundError:
+            pass
+        except Exception as error:
+            self.logger.warning('failed to read %s: %s', cache_path, error)
+
+        body = compress()
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                             suffix='.tmp')
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(body)
+            os.replace(temp_path, cache_path)
+        except OSError as error:
+            self.logger.warning('failed to write %s: %s', cache_path, error)
+        return body
+
+    def _open_cache(self):
+        if self.cache_dir is None:
+            return False
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            info = os.lstat(self.cache_dir)
+        except OSError as error:
+            self.logger.warning('not caching static assets in %s: %s',
+                                self.cache_dir, error)
+            return False
+        if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or
+                info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+            self.logger.warning('not caching static assets in %s since it '
+                                'is not a private directory', self.cache_dir)
+            return False
+        return True
+
+    def _build(self):
+        start = time.monotonic()
+        self._use_cache = self._open_cache()
+        assets, public = {}, {}
+        pending = {}
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                full_path = os.path.join(directory, filename)
+                path = os.path.relpath(full_path, self.root)
+                with open(full_path, 'rb') as asset_file:
+                    pending[path.replace(os.sep, '/')] = asset_file.read()
+
+        known = set(pending)
+        while pending:
+            ready = [path for path in sorted(pending)
+                     if not (self._references(path, pending[path], known) &
+                             set(pending) - {path})]
+            if not ready:
+                raise ValueError('static assets refer to each other: '
+                                 '{}'.format(', '.join(sorted(pending))))
+            for path in ready:
+                content_type = get_content_type(path)
+                content = pending.pop(path)
+                if content_type in TEXT_TYPES:
+                    content = self._rewrite(assets, path, content)
+                asset = Asset(path, content, content_type,
+                              self.load_variant)
+                assets[path] = asset
+                public[asset.public_path] = asset
+
+        self._assets, self._public = assets, public
+        self.logger.info('prepared %d static assets (%d bytes) in %.3fs',
+                         len(assets),
+                         sum(len(asset.variants['identity'])
+                             for asset in assets.values()),
+                         time.monotonic() - start)
+
+    def _references(self, path, content, known):
+        if get_content_type(path) not in TEXT_TYPES:
+            return set()
+        text = content.decode('utf-8')
+        references = set(self._absolute_reference.findall(text))
+        if path.endswith('.js'):
+            directory = posixpath.dirname(path)
+            references.update(posixpath.join(directory, module_id + '.js')
+                              for module_id in _MODULE_REFERENCE.findall(text))
+        return references & known
+
+    def _rewrite(self, assets, path, content):
+        def absolute(match):
+            asset = assets.get(match.group(1))
+            if asset is None:
+                return match.group(0)
+            return self.prefix + asset.public_path
+
+        def module(match):
+            asset = assets.get(
+                posixpath.join(directory, match.group(1) + '.js'))
+            if asset is None:
+                return match.group(0)
+            public_path = posixpath.relpath(asset.public_path, directory)
+            return '"{}"'.format(public_path[:-len('.js')])
+
+        directory = posixpath.dirname(path)
+        text = self._absolute_reference.sub(absolute,
+                                            content.decode('utf-8'))
+        if path.endswith('.js'):
+            text = _MODULE_REFERENCE.sub(module, text)
+        return text.encode('utf-8')
+
+
+class StaticAssetHandler(web.RequestHandler):
+    """
+    Serve the assets in an :class:`AssetManifest`.
+
+    Fingerprinted names are cached for a year and marked as
+    immutable.  Assets requested by their original names, including
+    the HTML documents, are revalidated on each use.  The smallest
+    encoding that the client accepts is sent.
+
+    This is used as the application's ``static_handler_class`` so
+    :meth:`~tornado.web.RequestHandler.static_url` generates the
+    fingerprinted URLs.
+
+    """
+
+    def initialize(self, manifest, path=None):
+        super(StaticAssetHandler, self).initialize()
+        self.manifest = manifest
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        manifest = settings['static_handler_args']['manifest']
+        return (settings.get('static_url_prefix', '/static/') +
+                manifest.public_path(path))
+
+    def head(self, path):
+        return self.get(path, include_body=False)
+
+    def get(self, path, include_body=True):
+        asset = self.manifest.find(path)
+        if asset is None:
+            raise web.HTTPError(404)
+
+        encoding, body = asset.select(
+            self.request.headers.get('Accept-Encoding', ''))
+        self.set_header('Content-Type', asset.content_type)
+        if len(asset.variants) > 1:
+            self.set_header('Vary', 'Accept-Encoding')
+        if encoding != 'identity':
+            self.set_header('Content-Encoding', encoding)
+        self.set_header('Etag', asset.etag(encoding))
+        if path == asset.public_path and path != asset.path:
+            self.set_header('Cache-Control', IMMUTABLE)
+        else:
+            self.set_header('Cache-Control', 'public, no-cache')
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        if include_body:
+            self.write(body)
+        else:
+            self.set_header('Content-Length', len(body))
+
+
+def get_content_type(path):
+    _, ext = posixpath.splitext(path)
+    try:
+        return CONTENT_TYPES[ext]
+    except KeyError:
+        content_type, _ = mimetypes.guess_type(path)
+        return content_type or 'application/octet-stream'
@@ -0,0 +1,166 @@
+import collections
+import logging
+import time
+
+from tornado import concurrent, gen
+
+
+class LRUCache(object):
+    """
+    Bounded in-process cache with per-entry expiration.
+
+    :param int max_size: maximum number of entries to retain.  The
+        least recently used entry is evicted when this is exceeded.
+    :param float ttl: number of seconds that an entry is valid for
+    :param clock: function that returns the current time in seconds
+    :param int max_bytes: optional limit on the total weight of the
+        cached values.  Least recently used entries are evicted until
+        the cache fits and a value that is heavier than the limit on
+        its own is not cached.
+    :param weigh: function that returns the size of a value in bytes.
+        This is required when `max_bytes` is set.
+
+    Entries are shared between callers so values should be treated
+    as read-only.  The :attr:`hits`, :attr:`misses`, and
+    :attr:`evictions` counters are updated as the cache is used and
+    :attr:`bytes` is the total weight of the cached values.
+
+    """
+
+    def __init__(self, max_size=1024, ttl=60.0, clock=time.monotonic,
+                 max_bytes=None, weigh=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.max_bytes = max_bytes
+        self.weigh = weigh
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        try:
+            self._lookup(key)
+            return True
+        except KeyError:
+            return False
+
+    def _lookup(self, key):
+        expires, value, weight = self._entries[key]
+        if expires <= self.clock():
+            del self._entries[key]
+            self.bytes -= weight
+            raise KeyError(key)
+        self._entries.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        """Retrieve `key` from the cache or return `default`."""
+        try:
+            value = self._lookup(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Add or replace `key` and evict old entries if necessary."""
+        weight = self.weigh(value) if self.weigh is not None else 0
+        self._discard(key)
+        if self.max_bytes is not None and weight > self.max_bytes:
+            return
+        self._entries[key] = (self.clock() + self.ttl, value, weight)
+        self.bytes += weight
+        while (len(self._entries) > self.max_size or
+               (self.max_bytes is not None and
+                self.bytes > self.max_bytes)):
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def _discard(self, key):
+        try:
+            _, _, weight = self._entries.pop(key)
+        except KeyError:
+            return
+        self.bytes -= weight
+
+    def invalidate(self, key):
+        """
+        Discard `key` from the cache.
+
+        A load of `key` that is in flight is also disowned so that its
+        result is returned to waiting callers without being cached.
+
+        """
+        self._discard(key)
+        self._pending.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._pending.clear()
+        self.bytes = 0
+
+    @gen.coroutine
+    def get_or_load(self, key, loader):
+        """
+        Retrieve `key` from the cache or load it.
+
+        :param key: cache key to retrieve
+        :param loader: function that returns an awaitable that resolves to
+            the value for `key`.  It is only called if `key` is not
+            cached and a load for `key` is not already in flight.
+
+        Concurrent misses for the same key share a single call to
+        `loader`.  Falsy values are returned but are not cached.
+
+        """
+        try:
+            value = self._lookup(key)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            raise gen.Return(value)
+
+        self.misses += 1
+        future = self._pending.get(key)
+        if future is None:
+            future = concurrent.Future()
+            self._pending[key] = future
+            self._load(key, loader, future)
+        value = yield future
+        raise gen.Return(value)
+
+    @gen.coroutine
+    def _load(self, key, loader, future):
+        try:
+            value = yield loader()
+        except Exception as error:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+            future.set_exception(error)
+            return
+
+        if self._pending.get(key) is future:
+            del self._pending[key]
+            if value:
+                self.set(key, value)
+        future.set_result(value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {'size': len(self._entries), 'hits': self.hits,
+                 'misses': self.misses, 'evictions': self.evictions,
+                 'hit_ratio': self.hits / lookups if lookups else 0.0}
+        if self.weigh is not None:
+            stats['bytes'] = self.bytes
+        return stats
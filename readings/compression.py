@@ -0,0 +1,126 @@
+import zlib
+
+from tornado import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+"""Content codings that responses can be compressed with, best first."""
+
+
+class CompressionTransform(web.OutputTransform):
+    """
+    Compress API responses with brotli or gzip.
+
+    Responses with one of the :attr:`content_types` are compressed with
+    the first of :data:`ENCODINGS` that the client accepts.  Responses
+    that are written in a single chunk are only compressed if they are
+    at least :attr:`min_length` bytes long, while streamed responses
+    are always compressed.  Responses that already have a
+    :http:header:`Content-Encoding` such as the static assets are
+    left alone.
+
+    Strong entity tags are weakened when the response is compressed
+    since the representation no longer matches byte-for-byte.
+
+    """
+
+    content_types = frozenset(['application/json', 'application/msgpack',
+                               'application/x-ndjson', 'text/csv'])
+    min_length = 1024
+    gzip_level = 6
+    brotli_quality = 5
+
+    def __init__(self, request):
+        self.encoding = choose_encoding(
+            request.headers.get('Accept-Encoding', ''), ENCODINGS)
+        self._compressor = None
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        content_type = headers.get('Content-Type', '').split(';')[0].strip()
+        if (content_type not in self.content_types or
+                'Content-Encoding' in headers):
+            return status_code, headers, chunk
+
+        if 'Vary' in headers:
+            headers['Vary'] += ', Accept-Encoding'
+        else:
+            headers['Vary'] = 'Accept-Encoding'
+        if self.encoding is None or (finishing and
+                                     len(chunk) < self.min_length):
+            return status_code, headers, chunk
+
+        headers['Content-Encoding'] = self.encoding
+        etag = headers.get('Etag')
+        if etag and not etag.startswith('W/'):
+            headers['Etag'] = 'W/' + etag
+        if self.encoding == 'br':
+            self._compressor = brotli.Compressor(quality=self.brotli_quality)
+        else:
+            self._compressor = zlib.compressobj(
+                self.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        chunk = self.transform_chunk(chunk, finishing)
+        if 'Content-Length' in headers:
+            if finishing:
+                headers['Content-Length'] = str(len(chunk))
+            else:
+                del headers['Content-Length']
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._compressor is None:
+            return chunk
+        if self.encoding == 'br':
+            chunk = self._compressor.process(chunk)
+            return chunk + (self._compressor.finish() if finishing
+                            else self._compressor.flush())
+        chunk = self._compressor.compress(chunk)
+        return chunk + self._compressor.flush(
+            zlib.Z_FINISH if finishing else zlib.Z_SYNC_FLUSH)
+
+
+def choose_encoding(accept_encoding, encodings):
+    """
+    Choose the first of `encodings` that the client accepts.
+
+    :param str accept_encoding: the request's
+        :http:header:`Accept-Encoding` header
+    :param encodings: the available content codings in order of
+        preference
+    :returns: the chosen content coding or :data:`None`
+
+    """
+    weights = parse_accept_encoding(accept_encoding)
+    for encoding in encodings:
+        if weights.get(encoding, weights.get('*', 0.0)) > 0.0:
+            return encoding
+    return None
+
+
+def parse_accept_encoding(header):
+    """
+    Parse an :http:header:`Accept-Encoding` header.
+
+    :returns: :class:`dict` that maps each lower-cased content coding
+        to its quality value
+
+    """
+    weights = {}
+    for item in header.split(','):
+        coding, _, parameters = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        weight = 1.0
+        name, _, value = parameters.partition('=')
+        if name.strip().lower() == 'q':
+            try:
+                weight = float(value)
+            except ValueError:
+                weight = 0.0
+        weights[coding] = weight
+    return weights
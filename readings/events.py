@@ -0,0 +1,70 @@
+import collections
+import logging
+
+from tornado import queues
+
+
+class EventBroker(object):
+    """
+    In-process publish/subscribe of per-user events.
+
+    :param int max_pending: number of events that may be queued for a
+        subscriber before it is considered stalled
+
+    Each subscriber receives ``(event_type, data, event_id)`` tuples
+    from the queue returned by :meth:`subscribe`.  A subscriber that
+    falls more than `max_pending` events behind has its queue replaced
+    with a single ``reset`` event so that it can reload instead of
+    holding an unbounded backlog.  :data:`None` is queued when the
+    subscriber should stop.
+
+    Events are only delivered to subscribers in the same process.
+
+    """
+
+    def __init__(self, max_pending=100):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.max_pending = max_pending
+        self.subscribers = collections.defaultdict(set)
+        self.closed = False
+
+    def subscribe(self, user_id):
+        queue = queues.Queue(maxsize=self.max_pending)
+        if self.closed:
+            queue.put_nowait(None)
+        else:
+            self.subscribers[user_id].add(queue)
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        """Stop delivering events to `queue` and wake its reader."""
+        subscribers = self.subscribers.get(user_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self.subscribers[user_id]
+        self._replace(queue, None)
+
+    def publish(self, user_id, event_type, data, event_id=None):
+        """Send an event to every subscriber of `user_id`."""
+        for queue in list(self.subscribers.get(user_id, ())):
+            try:
+                queue.put_nowait((event_type, data, event_id))
+            except queues.QueueFull:
+                self.logger.warning('subscriber of %s is stalled, resetting',
+                                    user_id)
+                self._replace(queue, ('reset', {}, event_id))
+
+    def close(self):
+        """Tell every subscriber to stop."""
+        self.closed = True
+        for subscribers in self.subscribers.values():
+            for queue in subscribers:
+                self._replace(queue, None)
+        self.subscribers.clear()
+
+    @staticmethod
+    def _replace(queue, item):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(item)
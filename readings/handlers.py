@@ -1,21 +1,56 @@
+from urllib import parse
+import collections
+import csv
 import datetime
+import hashlib
+import io
+import json
+import time
 
 from sprockets.http import mixins
-from sprockets.mixins.mediatype import content
-from tornado import concurrent, gen, web
+from sprockets.mixins.mediatype import content, transcoders
+from tornado import concurrent, escape, gen, iostream, web
+import bson.errors
 import bson.objectid
 import jwt.exceptions
 import pymongo
 import pytz
 
-from readings import helpers
+from readings import helpers, timing
 
 
-class UserMixin(web.RequestHandler):
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_BATCH_SIZE = 500
+BULK_BATCH_SIZE = 500
+SYNC_OVERLAP = datetime.timedelta(seconds=30)
+"""Changes this far before a sync token are sent again."""
+SEARCH_CANDIDATES = 1000
+"""Number of the newest matching readings that search results rank."""
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_FIELDS = ('title', 'url', 'added')
+IMPORT_MAX_BODY_SIZE = 1024 ** 3
+IMPORT_MAX_ERRORS = 100
+"""Number of failed records that an import response describes."""
+PRIMARY_COOKIE = 'read_primary'
+"""Cookie that keeps a client's reads on the primary after a change."""
+READY_TIMEOUT = 2.0
+"""Seconds that the readiness probe waits for the database."""
+
+
+class RenderedList(collections.namedtuple('RenderedList',
+                                          ['headers', 'body'])):
+    """A list response as it was sent, kept in the list cache."""
+
+    def weigh(self):
+        return len(self.body) + sum(len(name) + len(value)
+                                    for name, value in self.headers)
+
+
+class UserMixin(timing.TimingMixin):
 
     def initialize(self):
         super(UserMixin, self).initialize()
-        self.mongo = self.application.mongo
         self.user_info = None
 
     @gen.coroutine
@@ -30,19 +65,164 @@ class UserMixin(web.RequestHandler):
                 self.redirect(self.get_login_url())
                 return
 
-            self.user_info = yield self.mongo.find_one(
-                'users', bson.objectid.ObjectId(user_id.decode('ASCII')))
+            user_id = user_id.decode('ASCII')
+            with self.timings.phase('user'):
+                self.user_info = yield self.application.user_cache.get_or_load(
+                    user_id, lambda: self.mongo.find_one(
+                        'users', bson.objectid.ObjectId(user_id),
+                        projection=helpers.USER_FIELDS))
 
     def get_current_user(self):
         return self.user_info
 
+    @gen.coroutine
+    def get_readings_version(self):
+        """
+        Retrieve the current user's readings version from the database.
 
-class LoginHandler(helpers.AbsoluteReverseUrlMixin, content.ContentMixin,
-                   mixins.ErrorLogger, mixins.ErrorWriter, web.RequestHandler):
+        The version is read from the database instead of the user cache
+        since the cached copy may have been bumped by another process.
 
-    def initialize(self):
-        super(LoginHandler, self).initialize()
-        self.mongo = self.application.mongo
+        """
+        user_id = self.current_user['id']
+        user_info = yield self.mongo.find_one(
+            'users', bson.objectid.ObjectId(user_id),
+            projection=helpers.USER_FIELDS,
+            read_preference=self.get_read_preference())
+        if user_info:
+            self.application.user_cache.set(user_id, user_info)
+        raise gen.Return(user_info.get('readings_version', 0))
+
+    @gen.coroutine
+    def bump_readings_version(self):
+        """
+        Record that the current user's list of readings has changed.
+
+        This invalidates the entity tags of previous list responses
+        and pins the user's reads to the primary (see
+        :meth:`get_read_preference`).
+
+        """
+        user_id = self.current_user['id']
+        version = yield self.mongo.increment(
+            'users', {'_id': bson.objectid.ObjectId(user_id)},
+            'readings_version')
+        self.pin_to_primary()
+        user_info = self.current_user.copy()
+        user_info['readings_version'] = version
+        self.application.user_cache.set(user_id, user_info)
+        raise gen.Return(version)
+
+    def get_read_preference(self):
+        """
+        Choose where to read the current user's readings from.
+
+        Reads go to the primary for a while after the user changes
+        something, either in this process or from this client, so
+        that the change is visible even if the secondaries have not
+        caught up.  :data:`None` selects the configured read
+        preference otherwise.
+
+        """
+        if not self.application.primary_window:
+            return None
+        if self.application.is_pinned_to_primary(self.current_user['id']):
+            return pymongo.ReadPreference.PRIMARY
+        deadline = self.get_secure_cookie(PRIMARY_COOKIE, max_age_days=1)
+        if deadline and float(deadline.decode('ASCII')) > time.time():
+            return pymongo.ReadPreference.PRIMARY
+        return None
+
+    def pin_to_primary(self):
+        """
+        Read the current user's readings from the primary for a while.
+
+        The pin is recorded in the application, which covers the user's
+        other clients on this process, and in a cookie, which covers
+        this client on any process.
+
+        """
+        if not self.application.primary_window:
+            return
+        self.application.pin_to_primary(self.current_user['id'])
+        deadline = time.time() + self.application.primary_window
+        self.set_secure_cookie(PRIMARY_COOKIE, '{:.3f}'.format(deadline),
+                               expires=deadline)
+
+    def format_reading(self, doc):
+        return {'link': self.reverse_url('reading', str(doc['_id'])),
+                'href': doc['link'], 'title': doc['title'],
+                'added': get_added(doc)}
+
+    def format_readings(self, docs, remember=True):
+        """
+        Format listed readings.
+
+        :param docs: the reading documents to format
+        :param bool remember: cache the links of the readings for
+            redirects.  Pass :data:`False` for unbounded listings so
+            that they do not flush the link cache.
+
+        """
+        readings = []
+        for doc in docs:
+            if remember:
+                self.application.remember_link(self.current_user['id'],
+                                               doc['_id'], doc['link'])
+            readings.append(self.format_reading(doc))
+        return readings
+
+    def make_reading(self, item):
+        """
+        Create a new reading document from a request item.
+
+        :raises ValueError: if `item` is not a valid reading
+
+        """
+        if not isinstance(item, dict):
+            raise ValueError('reading must be an object')
+        for name in ('title', 'url'):
+            if not item.get(name) or not isinstance(item[name], str):
+                raise ValueError('{} is required'.format(name))
+        return {'user_id': self.current_user['id'],
+                'title': item['title'],
+                'link': item['url'],
+                'terms': helpers.search_terms(item['title'], item['url']),
+                'when': datetime.datetime.utcnow()}
+
+    @gen.coroutine
+    def record_removals(self, reading_ids):
+        """
+        Leave tombstones for removed readings.
+
+        The tombstones are what :http:get:`/` reports as removed when
+        it is asked for the changes since a sync token.  They expire
+        after :data:`readings.helpers.TOMBSTONE_TTL`.
+
+        """
+        now = datetime.datetime.utcnow()
+        yield self.mongo.insert_many(
+            'tombstones', [{'_id': reading_id,
+                            'user_id': self.current_user['id'],
+                            'deleted': now} for reading_id in reading_ids],
+            ordered=False)
+
+    def publish(self, event_type, data, version):
+        """
+        Notify the current user's event streams of a change.
+
+        :param str event_type: ``add`` or ``remove``
+        :param data: the event payload
+        :param int version: the readings version after the change
+
+        """
+        self.application.events.publish(self.current_user['id'], event_type,
+                                        data, version)
+
+
+class LoginHandler(timing.TimingMixin, helpers.AbsoluteReverseUrlMixin,
+                   content.ContentMixin, mixins.ErrorLogger,
+                   mixins.ErrorWriter, web.RequestHandler):
 
     def get(self):
         """
@@ -91,8 +271,9 @@ class LoginHandler(helpers.AbsoluteReverseUrlMixin, content.ContentMixin,
         """
         body = self.get_request_body()
 
-        user_info = yield self.mongo.find_one('users',
-                                              {'email': body['email']})
+        user_info = yield self.mongo.find_one(
+            'users', {'email': body['email']},
+            projection=dict(helpers.USER_FIELDS, email=True, password=True))
         if not user_info:
             raise web.HTTPError(404)
         scrubbed_info = user_info.copy()
@@ -121,7 +302,10 @@ class LoginHandler(helpers.AbsoluteReverseUrlMixin, content.ContentMixin,
             self.redirect(self.get_login_url(), status=303)
             raise web.Finish
 
-        self.set_secure_cookie('user', str(user_info['_id']), expires_days=1)
+        cached_info = user_info.copy()
+        del cached_info['password']
+        self.application.user_cache.set(user_info['id'], cached_info)
+        self.set_secure_cookie('user', user_info['id'], expires_days=1)
         self.redirect(self.static_url('index.html'), status=303)
 
 
@@ -137,10 +321,85 @@ class LogoutHandler(web.RequestHandler):
         :statuscode 302: redirects to the login page
 
         """
+        user_id = self.get_secure_cookie('user')
+        if user_id:
+            self.application.invalidate_user(user_id.decode('ASCII'))
         self.clear_cookie('user')
         self.redirect(self.reverse_url('login'))
 
 
+class MetricsHandler(web.RequestHandler):
+
+    def get(self):
+        """
+        Retrieve the service metrics.
+
+        The response is in the Prometheus text exposition format and
+        describes the process that answered the request.  It includes
+        request counts and latencies by route and status, database
+        operation timings, retries and errors, connection pool usage,
+        and event loop lag.
+
+        :statuscode 200: the response includes the current metrics
+
+        """
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(self.application.collect_metrics())
+
+
+class HealthHandler(web.RequestHandler):
+
+    def get(self):
+        """
+        Check that the process is alive.
+
+        This does not touch the database or identify the user so it
+        succeeds as long as the IOLoop is responsive.  Use it as a
+        liveness probe.
+
+        :statuscode 200: the process is serving requests
+
+        """
+        self.set_header('Content-Type', 'text/plain')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write('ok\n')
+
+
+class ReadinessHandler(mixins.LoggingHandler, web.RequestHandler):
+
+    @gen.coroutine
+    def get(self):
+        """
+        Check that the process can serve user requests.
+
+        The process is ready once it has finished starting up and until
+        it begins to shut down, as long as the database answers a ping
+        within :data:`READY_TIMEOUT` seconds.  Use it as a readiness
+        probe so that traffic is only routed to ready processes.
+
+        :statuscode 200: the process is ready
+        :statuscode 503: the process is starting, stopping, or cannot
+            reach the database.  The body describes which.
+
+        """
+        self.set_header('Content-Type', 'text/plain')
+        self.set_header('Cache-Control', 'no-cache')
+        if not self.application.ready:
+            self.set_status(503)
+            self.write('not ready\n')
+            return
+
+        try:
+            yield self.application.mongo.ping(timeout=READY_TIMEOUT)
+        except Exception as error:
+            self.logger.warning('database ping failed - %r', error)
+            self.set_status(503)
+            self.write('database unavailable\n')
+            return
+        self.write('ready\n')
+
+
 class ReadingsHandler(UserMixin, helpers.AbsoluteReverseUrlMixin,
                       helpers.AJAXRedirectMixin, content.ContentMixin,
                       mixins.ErrorLogger, mixins.ErrorWriter,
@@ -148,77 +407,746 @@ class ReadingsHandler(UserMixin, helpers.AbsoluteReverseUrlMixin,
 
     def initialize(self):
         super(ReadingsHandler, self).initialize()
-        self.mongo = self.application.mongo
+        self.rendered = None
 
     @web.authenticated
     @gen.coroutine
     def get(self):
         """
-        Retrieve a list of readings.
+        Retrieve a page of readings.
+
+        :query int limit: maximum number of readings to return.  This
+            defaults to 50 and is capped at 500.  Use ``0`` to retrieve
+            every reading in a single streamed response.
+        :query str after: opaque continuation token from the
+            :http:header:`Link` header of the previous page
+        :query str since: opaque token from the :http:header:`Sync-Token`
+            header or a previous response.  This retrieves the changes
+            since the token instead of the list.
 
         :>jsonarr str link: canonical link to this reading
         :>jsonarr str href: external link to the reading content
         :>jsonarr str added: date that this reading was added
 
-        Use this method to retrieve the list of readings as a JSON array.
-        It requires that you are already *authenticated*.  If you are not
-        authenticated, then you will be redirected to the login page.
+        Use this method to retrieve the list of readings as a JSON array,
+        newest first.  It requires that you are already *authenticated*.
+        If you are not authenticated, then you will be redirected to the
+        login page.
+
+        Readings are returned a page at a time.  If more readings are
+        available, then the response includes a :http:header:`Link`
+        header with ``rel="next"`` that identifies the next page.
+
+        JSON responses are streamed to the client in batches using
+        chunked transfer encoding as they are read from the database.
+
+        The response includes a strong :http:header:`Etag` that changes
+        whenever a reading is added or removed.  Send it back in the
+        :http:header:`If-None-Match` header to retrieve the list only if
+        it has changed.
+
+        Pages are also kept in a server-side cache that is keyed by the
+        entity tag, so repeated requests for an unchanged page are sent
+        without querying or serializing the readings again.  Unlimited
+        streamed responses and pages that were read from a secondary
+        are not cached.
+
+        The :http:header:`Sync-Token` response header identifies when
+        the list was retrieved.  Pass it as the `since` parameter to
+        retrieve a JSON object with the readings that were ``added``
+        since then, the canonical links of the readings that were
+        ``removed``, and a new ``token`` for the next request.  Changes
+        that were made shortly before the token may be repeated so
+        apply them idempotently.  If the token is too old or too much
+        has changed, then the response is a 410 and the list should be
+        retrieved again.
 
         :statuscode 200: the response includes the list of readings
+        :statuscode 304: the list has not changed since the entity tag
+            in :http:header:`If-None-Match` was generated
         :statuscode 302: you have not logged in.  The :http:header:`Location`
             header will redirect to the login page.
         :statuscode 303: the request is not an AJAX request.  The
             :http:header:`Location` header will redirect to the root
             page since that is probably what you wanted anyway.
+        :statuscode 400: the `limit`, `after`, or `since` parameter is
+            invalid
+        :statuscode 410: the changes since the `since` token are not
+            available
+        :resheader Link: identifies the next page of readings, if any
+        :resheader Etag: identifies this version of the list
+        :resheader Sync-Token: identifies when the list was retrieved
 
         """
         if self.is_ajax_request():
-            self.logger.debug('retrieving readings for %s',
-                              self.current_user['id'])
-            docs = yield self.mongo.find('readings',
-                                         {'user_id': self.current_user['id']},
-                                         'when', pymongo.DESCENDING)
-            readings = [{'link': self.reverse_url('reading', str(doc['_id'])),
-                         'href': doc['link'], 'title': doc['title'],
-                         'added': doc['when'].replace(tzinfo=pytz.utc)}
-                        for doc in docs]
-            self.send_response(readings)
-            self.finish()
+            since = self.get_query_argument('since', None)
+            if since is not None:
+                yield self.send_changes(since)
+                return
+
+            limit = self.get_page_size()
+            start_after = None
+            token = self.get_query_argument('after', None)
+            if token:
+                try:
+                    start_after = helpers.decode_page_token(token)
+                except ValueError:
+                    raise web.HTTPError(400, 'invalid page token %r', token)
+
+            read_preference = self.get_read_preference()
+            self.set_header('Sync-Token', self.make_sync_token(
+                datetime.datetime.utcnow(), read_preference))
+            version = yield self.get_readings_version()
+            etag = self.compute_list_etag(version)
+            self.set_header('Etag', etag)
+            self.set_header('Cache-Control', 'private, no-cache')
+            if self.check_etag_header():
+                self.logger.debug('readings for %s are unchanged',
+                                  self.current_user['id'])
+                self.set_status(304)
+                self.finish()
+                return
+
+            cached = self.application.list_cache.get(etag) if limit else None
+            if cached is not None:
+                for name, value in cached.headers:
+                    self.set_header(name, value)
+                self.add_header('Vary', 'Accept')
+                self.write(cached.body)
+                self.finish()
+                return
+            # a page that was read from a lagging secondary must not be
+            # cached under the entity tag of a newer version
+            if limit and (read_preference is not None or
+                          not self.application.primary_window):
+                self.rendered = []
+
+            self.logger.debug('retrieving %d readings for %s after %r',
+                              limit, self.current_user['id'], start_after)
+            query = {'user_id': self.current_user['id']}
+            if self.get_response_content_type() == 'application/json':
+                writer = helpers.JSONArrayWriter(self)
+
+                def on_batch(docs):
+                    docs = self.trim_page(docs, limit)
+                    with self.timings.phase('serialize'):
+                        writer.write_items(
+                            self.format_readings(docs, remember=bool(limit)))
+                    return self.flush()
+
+                yield self.mongo.find(
+                    'readings', query, helpers.READINGS_SORT,
+                    projection=helpers.READING_FIELDS,
+                    limit=limit + 1 if limit else None,
+                    start_after=start_after,
+                    batch_size=limit + 1 if limit else STREAM_BATCH_SIZE,
+                    on_batch=on_batch, read_preference=read_preference)
+                writer.finish()
+            else:
+                docs = yield self.mongo.find(
+                    'readings', query, helpers.READINGS_SORT,
+                    projection=helpers.READING_FIELDS,
+                    limit=limit + 1 if limit else None,
+                    start_after=start_after, read_preference=read_preference)
+                docs = self.trim_page(docs, limit)
+                self.send_response(
+                    self.format_readings(docs, remember=bool(limit)))
+                self.finish()
+
+            if self.rendered is not None:
+                self.application.list_cache.set(etag, RenderedList(
+                    headers=tuple((name, self._headers[name])
+                                  for name in ('Content-Type', 'Link')
+                                  if name in self._headers),
+                    body=b''.join(self.rendered)))
         else:
             self.logger.debug('not an AJAX request, redirecting to index')
             self.logger.debug('headers: %r', dict(self.request.headers))
             self.redirect(self.static_url('index.html'), status=303)
 
+    @gen.coroutine
+    def send_changes(self, token):
+        """Send the readings added and removed since `token`."""
+        try:
+            since = helpers.decode_sync_token(token)
+        except ValueError:
+            raise web.HTTPError(400, 'invalid sync token %r', token)
+
+        now = datetime.datetime.utcnow()
+        if since < now - helpers.TOMBSTONE_TTL:
+            raise web.HTTPError(410, 'sync token %r has expired', token)
+
+        # a reading is timestamped before it is saved so changes that
+        # were in flight when the token was issued are sent again
+        since -= SYNC_OVERLAP
+        user_id = self.current_user['id']
+        read_preference = self.get_read_preference()
+        added = yield self.mongo.find(
+            'readings', {'user_id': user_id, 'when': {'$gt': since}},
+            helpers.READINGS_SORT, projection=helpers.READING_FIELDS,
+            limit=MAX_PAGE_SIZE + 1, read_preference=read_preference)
+        if len(added) > MAX_PAGE_SIZE:
+            raise web.HTTPError(410, 'too many changes since %r', token)
+        removed = yield self.mongo.find(
+            'tombstones', {'user_id': user_id, 'deleted': {'$gt': since}},
+            projection={'_id': True}, read_preference=read_preference)
+
+        self.logger.debug('%d readings added and %d removed for %s since %s',
+                          len(added), len(removed), user_id, since)
+        self.set_header('Cache-Control', 'private, no-cache')
+        self.send_response({
+            'added': self.format_readings(added),
+            'removed': [self.reverse_url('reading', str(doc['_id']))
+                        for doc in removed],
+            'token': self.make_sync_token(now, read_preference)})
+        self.finish()
+
+    def make_sync_token(self, now, read_preference):
+        """
+        Encode a sync token for readings that were retrieved at `now`.
+
+        A secondary may not have replicated the changes made shortly
+        before `now` yet, so the token is back-dated by the maximum
+        replication lag when `read_preference` lets the read go to a
+        secondary.  The next sync then sends those changes again.
+
+        """
+        if read_preference is None and self.application.max_lag:
+            now -= datetime.timedelta(seconds=self.application.max_lag)
+        return helpers.encode_sync_token(now)
+
+    def write(self, chunk):
+        super(ReadingsHandler, self).write(chunk)
+        if self.rendered is not None:
+            self.rendered.append(escape.utf8(chunk))
+
+    def get_page_size(self):
+        try:
+            limit = int(self.get_query_argument('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            raise web.HTTPError(400, 'limit must be an integer')
+        if limit < 0:
+            raise web.HTTPError(400, 'limit cannot be negative')
+        return min(limit, MAX_PAGE_SIZE)
+
+    def compute_list_etag(self, version):
+        """
+        Generate the entity tag for a list response.
+
+        The tag is derived from the user's readings version and every
+        other input that affects the representation -- the requested
+        page, the negotiated content type, and the host that absolute
+        links are generated for.
+
+        """
+        digest = hashlib.sha1()
+        for value in (self.current_user['id'], str(version),
+                      self.request.protocol, self.request.host,
+                      self.request.query, self.get_response_content_type()):
+            digest.update(value.encode('utf-8'))
+            digest.update(b'\0')
+        return '"{}"'.format(digest.hexdigest())
+
+    def trim_page(self, docs, limit):
+        """
+        Trim `docs` to `limit` and link to the next page if necessary.
+
+        The list query retrieves ``limit + 1`` documents.  If the extra
+        document is present, then it is dropped and a ``rel="next"``
+        :http:header:`Link` header is generated from the last document
+        that remains.
+
+        """
+        if limit and len(docs) > limit:
+            docs = docs[:limit]
+            last = docs[-1]
+            next_url = '{}?{}'.format(
+                self.reverse_url('readings'),
+                parse.urlencode([
+                    ('limit', limit),
+                    ('after', helpers.encode_page_token(last['when'],
+                                                        last['_id']))]))
+            self.set_header('Link', '<{}>; rel="next"'.format(next_url))
+        return docs
+
     @web.authenticated
     @gen.coroutine
     def post(self):
         """
         Add something to the list.
 
-        :<jsonarr str title: title of the page/article
-        :<jsonarr str link: link to the page
+        :<json str title: title of the page/article
+        :<json str url: link to the page
+
+        :query bool ordered: when adding many readings, stop at the
+            first failure (the default) or attempt all of them when
+            this is ``false``
 
-        :statuscode 204: the reading was added and is available by retrieving
+        The addition is also published to the user's event streams
+        (see :http:get:`/events`).
+
+        The request body is either a single reading or an array of
+        readings.  When the body is form-encoded, repeat the ``title``
+        and ``url`` parameters to add many readings at once.  Many
+        readings are inserted in batches and the response is an array
+        that describes the outcome of each one, in the order that they
+        were submitted.
+
+        :>jsonarr int status: ``201`` if the reading was added, ``400``
+            if it is invalid, ``409`` if it conflicts with an existing
+            reading, or ``424`` if it was not attempted because an
+            earlier reading failed in an *ordered* request
+        :>jsonarr str link: canonical link to the new reading
+        :>jsonarr str error: describes why the reading was not added
+
+        :statuscode 200: many readings were processed.  The response
+            describes the result for each reading.
+        :statuscode 201: the reading was added and is available by retrieving
             the resource identified by the :http:header:`Location` header.
+            The response body describes the new reading in the same form
+            as :http:get:`/`.
         :statuscode 302: you have not logged in.  The :http:header:`Location`
             header will redirect to the login page.
+        :statuscode 400: the reading is invalid
         :resheader Location: the canonical location for the created reading.
 
         """
-        body = self.get_request_body()
-        new_doc = {'user_id': self.current_user['id'],
-                   'title': body['title'],
-                   'link': body['url'],
-                   'when': datetime.datetime.utcnow()}
+        items = self.get_request_readings()
+        if items is not None:
+            yield self.add_many(items)
+            return
+
+        try:
+            new_doc = self.make_reading(self.get_request_body())
+        except ValueError as error:
+            raise web.HTTPError(400, '%s', error)
 
         self.logger.debug('adding reading - %r', new_doc)
-        doc_id = yield self.mongo.save('readings', new_doc)
-        self.set_header('Location', self.reverse_url('reading', doc_id))
+        new_doc['_id'] = yield self.mongo.insert('readings', new_doc)
+        self.application.remember_link(new_doc['user_id'], new_doc['_id'],
+                                       new_doc['link'])
+        version = yield self.bump_readings_version()
+        reading = self.format_reading(new_doc)
+        self.publish('add', reading, version)
+        self.set_header('Location', reading['link'])
         self.set_header('Access-Control-Allow-Origin', self.request.headers['Origin'])
         self.set_header('Access-Control-Allow-Methods', 'GET')
-        self.set_status(204)
+        self.set_status(201)
+        self.send_response(reading)
         self.finish()
 
+    @web.authenticated
+    @gen.coroutine
+    def delete(self):
+        """
+        Remove many readings.
+
+        :<jsonarr str id: identifier or canonical link of a reading
+
+        The request body is an array of reading identifiers (or their
+        canonical links as returned from :http:get:`/`).  When the body
+        is form-encoded, repeat the ``id`` parameter for each reading.
+        Readings are removed in batches and the response is an array
+        that describes the outcome for each identifier, in the order
+        that they were submitted.
+
+        :>jsonarr str id: the identifier from the request
+        :>jsonarr int status: ``204`` if the reading was removed,
+            ``404`` if it does not exist, or ``400`` if the identifier
+            is invalid
+
+        :statuscode 200: the response describes the result for each
+            identifier
+        :statuscode 302: you have not logged in.  The :http:header:`Location`
+            header will redirect to the login page.
+        :statuscode 400: the request body is not a list of identifiers
+
+        """
+        body = self.get_request_body()
+        if isinstance(body, dict):
+            body = body.get('id', [])
+        if isinstance(body, str):
+            body = [body]
+        if not isinstance(body, list):
+            raise web.HTTPError(400, 'expected a list of identifiers')
+
+        results = [{'id': value, 'status': 400} for value in body]
+        positions = {}
+        for index, value in enumerate(body):
+            try:
+                reading_id = bson.objectid.ObjectId(
+                    value.rstrip('/').rpartition('/')[2])
+            except (AttributeError, TypeError, bson.errors.InvalidId):
+                continue
+            positions.setdefault(reading_id, []).append(index)
+
+        reading_ids, deleted, removed = list(positions), 0, []
+        for start in range(0, len(reading_ids), BULK_BATCH_SIZE):
+            batch_ids = reading_ids[start:start + BULK_BATCH_SIZE]
+            query = {'_id': {'$in': batch_ids},
+                     'user_id': self.current_user['id']}
+            existing = yield self.mongo.find(
+                'readings', query, projection={'_id': True},
+                read_preference=pymongo.ReadPreference.PRIMARY)
+            deleted += yield self.mongo.delete_many('readings', query)
+            found = {doc['_id'] for doc in existing}
+            for reading_id in found:
+                self.application.forget_link(self.current_user['id'],
+                                             reading_id)
+                removed.append(self.reverse_url('reading', str(reading_id)))
+            if found:
+                yield self.record_removals(found)
+            for reading_id in query['_id']['$in']:
+                for index in positions[reading_id]:
+                    results[index]['status'] = (204 if reading_id in found
+                                                else 404)
+
+        self.logger.debug('removed %d of %d readings', deleted, len(body))
+        if deleted:
+            version = yield self.bump_readings_version()
+            for link in removed:
+                self.publish('remove', {'link': link}, version)
+        self.send_response(results)
+        self.finish()
+
+    def get_request_readings(self):
+        """
+        Retrieve the list of readings to add from the request body.
+
+        :returns: a :class:`list` of readings or :data:`None` if the
+            body contains a single reading
+        :raises tornado.web.HTTPError: if the body is neither an object
+            nor an array
+
+        """
+        body = self.get_request_body()
+        if isinstance(body, list):
+            return body
+        if not isinstance(body, dict):
+            raise web.HTTPError(400, 'expected an object or an array, '
+                                'not %s', type(body).__name__)
+
+        titles, urls = body.get('title'), body.get('url')
+        if isinstance(titles, list) or isinstance(urls, list):
+            titles = titles if isinstance(titles, list) else [titles]
+            urls = urls if isinstance(urls, list) else [urls]
+            if len(titles) != len(urls):
+                raise web.HTTPError(400, 'found %d titles and %d urls',
+                                    len(titles), len(urls))
+            return [{'title': title, 'url': url}
+                    for title, url in zip(titles, urls)]
+
+        return None
+
+    @gen.coroutine
+    def add_many(self, items):
+        ordered = self.get_query_argument('ordered', 'true').lower() not in (
+            'false', 'no', '0')
+        results = [{'status': 424, 'error': 'not attempted'}] * len(items)
+        new_docs, positions = [], []
+        for index, item in enumerate(items):
+            try:
+                new_docs.append(self.make_reading(item))
+                positions.append(index)
+            except ValueError as error:
+                results[index] = {'status': 400, 'error': str(error)}
+                if ordered:
+                    break
+
+        self.logger.debug('adding %d readings (ordered=%r)', len(new_docs),
+                          ordered)
+        inserted = yield self.mongo.insert_many('readings', new_docs,
+                                                ordered=ordered,
+                                                batch_size=BULK_BATCH_SIZE)
+        added = []
+        for index, doc, (doc_id, error) in zip(positions, new_docs, inserted):
+            if doc_id is not None:
+                results[index] = {'status': 201,
+                                  'link': self.reverse_url('reading', doc_id)}
+                self.application.remember_link(doc['user_id'], doc_id,
+                                               doc['link'])
+                doc['_id'] = doc_id
+                added.append(doc)
+            elif error['code'] is not None:
+                duplicate = error['code'] == helpers.DUPLICATE_KEY
+                results[index] = {'status': 409 if duplicate else 500,
+                                  'error': error['errmsg']}
+
+        if added:
+            version = yield self.bump_readings_version()
+            for doc in added:
+                self.publish('add', self.format_reading(doc), version)
+        self.send_response(results)
+        self.finish()
+
+
+class SearchHandler(UserMixin, helpers.AbsoluteReverseUrlMixin,
+                    helpers.AJAXRedirectMixin, content.ContentMixin,
+                    mixins.ErrorLogger, mixins.ErrorWriter,
+                    web.RequestHandler):
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self):
+        """
+        Search for readings.
+
+        :query str q: words to search for.  A reading matches if every
+            word starts a word in its title or link, so partial words
+            can be searched for as they are typed.
+        :query int limit: maximum number of readings to return.  This
+            defaults to 50 and cannot exceed 500.
+        :query int offset: number of results to skip
+
+        The response has the same form as :http:get:`/` with the best
+        matches first.  Readings whose titles match are ranked above
+        those that only match by link, and whole words are ranked
+        above partial words.  Only the newest 1000 matching readings
+        are ranked.
+
+        :statuscode 200: the response contains the matching readings
+        :statuscode 302: you have not logged in.  The :http:header:`Location`
+            header will redirect to the login page.
+        :statuscode 400: the `q`, `limit`, or `offset` parameter is
+            invalid
+        :resheader Link: identifies the next page of results, if any
+
+        """
+        query = self.get_query_argument('q', '')
+        words = helpers.tokenize(query)
+        if not words:
+            raise web.HTTPError(400, 'nothing to search for in %r', query)
+        try:
+            limit = int(self.get_query_argument('limit', DEFAULT_PAGE_SIZE))
+            offset = int(self.get_query_argument('offset', '0'))
+        except ValueError:
+            raise web.HTTPError(400, 'limit and offset must be integers')
+        if limit < 1 or offset < 0:
+            raise web.HTTPError(400, 'limit or offset is out of range')
+        limit = min(limit, MAX_PAGE_SIZE)
+
+        user_id = self.current_user['id']
+        docs = yield self.mongo.find(
+            'readings', helpers.build_search_query(user_id, words),
+            helpers.READINGS_SORT, projection=helpers.SEARCH_FIELDS,
+            limit=SEARCH_CANDIDATES,
+            read_preference=self.get_read_preference())
+        self.logger.debug('%d readings of %s match %r', len(docs), user_id,
+                          words)
+        docs = helpers.rank_readings(docs, words)
+        if len(docs) > offset + limit:
+            next_url = '{}?{}'.format(
+                self.reverse_url('search'),
+                parse.urlencode([('q', query), ('limit', limit),
+                                 ('offset', offset + limit)]))
+            self.set_header('Link', '<{}>; rel="next"'.format(next_url))
+
+        self.set_header('Cache-Control', 'private, no-cache')
+        self.send_response(self.format_readings(docs[offset:offset + limit]))
+        self.finish()
+
+
+class ExportHandler(UserMixin, helpers.AbsoluteReverseUrlMixin,
+                    helpers.AJAXRedirectMixin, mixins.ErrorLogger,
+                    web.RequestHandler):
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self):
+        """
+        Download every reading.
+
+        :query str format: ``ndjson`` (the default) for one JSON object
+            per line or ``csv`` for comma-separated values with a header
+            row
+
+        Each reading is described by its ``title``, ``url``, and
+        ``added`` timestamp, newest first.  This is the format that
+        :http:post:`/import` accepts.  The readings are streamed from
+        the database in batches so the export is never held in memory.
+
+        :statuscode 200: the response contains every reading
+        :statuscode 302: you have not logged in.  The :http:header:`Location`
+            header will redirect to the login page.
+        :statuscode 400: the `format` parameter is not supported
+
+        """
+        export_format = self.get_query_argument('format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            raise web.HTTPError(400, 'unsupported export format %r',
+                                export_format)
+
+        self.set_header('Content-Type', '{}; charset="utf-8"'.format(
+            EXPORT_FORMATS[export_format]))
+        self.set_header('Content-Disposition',
+                        'attachment; filename="readings.{}"'.format(
+                            export_format))
+        self.set_header('Cache-Control', 'private, no-cache')
+        transcoder = transcoders.JSONTranscoder()
+        if export_format == 'csv':
+            self.write(_csv_row(EXPORT_FIELDS))
+
+        def on_batch(docs):
+            with self.timings.phase('serialize'):
+                for doc in docs:
+                    added = get_added(doc)
+                    if export_format == 'csv':
+                        self.write(_csv_row([doc['title'], doc['link'],
+                                             added.isoformat()]))
+                    else:
+                        self.write(transcoder.dumps(
+                            {'title': doc['title'], 'url': doc['link'],
+                             'added': added}) + '\n')
+            return self.flush()
+
+        exported = yield self.mongo.find(
+            'readings', {'user_id': self.current_user['id']},
+            helpers.READINGS_SORT, projection=helpers.READING_FIELDS,
+            batch_size=STREAM_BATCH_SIZE, on_batch=on_batch,
+            read_preference=self.get_read_preference())
+        self.logger.info('exported %d readings for %s', exported,
+                         self.current_user['id'])
+        self.finish()
+
+
+@web.stream_request_body
+class ImportHandler(UserMixin, helpers.AbsoluteReverseUrlMixin,
+                    content.ContentMixin, mixins.ErrorLogger,
+                    mixins.ErrorWriter, web.RequestHandler):
+
+    def initialize(self):
+        super(ImportHandler, self).initialize()
+        self.reader = None
+        self.parse_record = None
+        self.columns = None
+        self.started = datetime.datetime.utcnow()
+        self.pending = []
+        self.added = 0
+        self.failures = []
+        self.failed = 0
+
+    @gen.coroutine
+    def prepare(self):
+        yield super(ImportHandler, self).prepare()
+        if self._finished:
+            return
+
+        content_type = self.request.headers.get('Content-Type', '')
+        content_type = content_type.partition(';')[0].strip().lower()
+        if content_type == EXPORT_FORMATS['ndjson']:
+            self.reader = helpers.RecordReader()
+            self.parse_record = json.loads
+        elif content_type == EXPORT_FORMATS['csv']:
+            self.reader = helpers.RecordReader(quoted=True)
+            self.parse_record = self.parse_csv_record
+        else:
+            raise web.HTTPError(415, 'cannot import %r', content_type)
+        self.request.connection.set_max_body_size(IMPORT_MAX_BODY_SIZE)
+
+    @gen.coroutine
+    def data_received(self, chunk):
+        if self.reader is None:
+            return
+        self.add_records(self.reader.feed(chunk))
+        if len(self.pending) >= BULK_BATCH_SIZE:
+            yield self.insert_pending()
+
+    @web.authenticated
+    @gen.coroutine
+    def post(self):
+        """
+        Add readings from an export.
+
+        :reqheader Content-Type: ``application/x-ndjson`` for one JSON
+            object per line or ``text/csv`` for comma-separated values
+            with a header row
+
+        Each record requires a ``title`` and ``url`` and may include the
+        ``added`` timestamp that :http:get:`/export` writes.  Readings
+        without a timestamp are added now.  Imported readings are listed
+        and synchronized as of the import so that other clients see
+        them in the changes since their sync token, while the ``added``
+        timestamp is kept for display.  Each line is listed a
+        millisecond before the line above it so the readings keep the
+        newest-first order of the export.
+
+        The request body is parsed as it arrives and the readings are
+        inserted in batches of 500 so that large imports run in constant
+        memory.  Invalid records are skipped and reported.  Open event
+        streams receive a ``reset`` event once the import completes.
+
+        :>json int added: number of readings that were added
+        :>json int failed: number of records that were not added
+        :>json list errors: the ``line`` number and ``error`` message of
+            the first 100 records that were not added
+
+        :statuscode 200: the import completed.  The response describes
+            the result.
+        :statuscode 302: you have not logged in.  The :http:header:`Location`
+            header will redirect to the login page.
+        :statuscode 415: the request body is not in a supported format
+
+        """
+        self.add_records(self.reader.close())
+        if self.pending:
+            yield self.insert_pending()
+
+        self.logger.info('imported %d readings for %s, %d failed',
+                         self.added, self.current_user['id'], self.failed)
+        if self.added:
+            version = yield self.bump_readings_version()
+            self.publish('reset', {}, version)
+        self.send_response({'added': self.added, 'failed': self.failed,
+                            'errors': self.failures})
+        self.finish()
+
+    def parse_csv_record(self, text):
+        row = next(csv.reader([text]))
+        if self.columns is None:
+            self.columns = [column.strip().lower() for column in row]
+            return None
+        return dict(zip(self.columns, row))
+
+    def add_records(self, records):
+        for line_number, record in records:
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                item = self.parse_record(record)
+                if item is None:
+                    continue
+                doc = self.make_reading(item)
+                # later lines were added earlier; the offsets stay well
+                # within SYNC_OVERLAP for any import that sync can send
+                doc['when'] = self.started - datetime.timedelta(
+                    milliseconds=line_number)
+                added = item.get('added')
+                if added:
+                    if not isinstance(added, str):
+                        raise ValueError('added must be a timestamp')
+                    doc['added'] = helpers.parse_timestamp(added)
+            except (ValueError, csv.Error) as error:
+                self.add_failure(line_number, str(error))
+            else:
+                self.pending.append((line_number, doc))
+
+    def add_failure(self, line_number, message):
+        self.failed += 1
+        if len(self.failures) < IMPORT_MAX_ERRORS:
+            self.failures.append({'line': line_number, 'error': message})
+
+    @gen.coroutine
+    def insert_pending(self):
+        batch, self.pending = self.pending, []
+        results = yield self.mongo.insert_many(
+            'readings', [doc for _, doc in batch], ordered=False,
+            batch_size=BULK_BATCH_SIZE)
+        for (line_number, _), (doc_id, error) in zip(batch, results):
+            if doc_id is None:
+                self.add_failure(line_number, error['errmsg'])
+            else:
+                self.added += 1
+
 
 class ReadingHandler(UserMixin, helpers.AbsoluteReverseUrlMixin,
                      helpers.AJAXRedirectMixin, content.ContentMixin,
@@ -234,18 +1162,35 @@ class ReadingHandler(UserMixin, helpers.AbsoluteReverseUrlMixin,
         :param str reading_id: the unique identifier of the reading to
             jump to
 
+        The location of recently listed, added, or opened readings is
+        cached so repeated visits do not need to query the database.
+
         :statuscode 302: redirects to the reading content or the login
             page if you are not logged in
+        :statuscode 404: the reading does not exist
         :resheader Location: the location of the reading content
 
         """
-        db = self.application.mongo.mongo.readings
-        coll = db.readings
-        cursor = coll.find({'user_id': self.current_user['id'],
-                            '_id': bson.objectid.ObjectId(reading_id)})
-        yield cursor.fetch_next
-        reading = cursor.next_object()
-        self.redirect(reading['link'])
+        try:
+            reading_id = bson.objectid.ObjectId(reading_id)
+        except bson.errors.InvalidId:
+            raise web.HTTPError(404)
+
+        user_id = self.current_user['id']
+        link = yield self.application.link_cache.get_or_load(
+            (user_id, str(reading_id)),
+            lambda: self.load_link(user_id, reading_id))
+        if not link:
+            raise web.HTTPError(404)
+        self.redirect(link)
+
+    @gen.coroutine
+    def load_link(self, user_id, reading_id):
+        reading = yield self.mongo.find_one(
+            'readings', {'_id': reading_id, 'user_id': user_id},
+            projection={'link': True},
+            read_preference=self.get_read_preference())
+        raise gen.Return(reading.get('link'))
 
     @web.authenticated
     @gen.coroutine
@@ -256,12 +1201,124 @@ class ReadingHandler(UserMixin, helpers.AbsoluteReverseUrlMixin,
         :param str reading_id: the unique identifier of the reading
             to remove
 
+        The removal is also published to the user's event streams
+        (see :http:get:`/events`).
+
+        :statuscode 200: the reading was removed.  The response body
+            describes it in the same form as :http:get:`/`.
+        :statuscode 404: the reading does not exist
+
         """
-        db = self.application.mongo.mongo.readings
-        result = yield db.readings.delete_one(
-            {'_id': bson.objectid.ObjectId(reading_id)})
-        if result.deleted_count:
-            self.set_status(204)
-        else:
-            self.set_status(404)
+        try:
+            reading_id = bson.objectid.ObjectId(reading_id)
+        except bson.errors.InvalidId:
+            raise web.HTTPError(404)
+
+        reading = yield self.mongo.remove_one(
+            'readings', {'_id': reading_id,
+                         'user_id': self.current_user['id']},
+            projection=helpers.READING_FIELDS)
+        self.application.forget_link(self.current_user['id'], reading_id)
+        if not reading:
+            raise web.HTTPError(404)
+
+        yield self.record_removals([reading_id])
+        version = yield self.bump_readings_version()
+        reading = self.format_reading(reading)
+        self.publish('remove', {'link': reading['link']}, version)
+        self.send_response(reading)
         self.finish()
+
+
+class EventsHandler(UserMixin, helpers.AbsoluteReverseUrlMixin,
+                    mixins.ErrorLogger, web.RequestHandler):
+
+    keepalive_interval = 15.0
+    """Seconds between comments that keep idle connections open."""
+
+    profiled = False
+
+    def initialize(self):
+        super(EventsHandler, self).initialize()
+        self.queue = None
+        self.stream_closed = False
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self):
+        """
+        Stream changes to the list of readings.
+
+        The response is a `server-sent events`_ stream that stays open
+        until the client disconnects.  An ``add`` event is sent when
+        a reading is added; its data is the reading in the same form
+        as :http:get:`/`.  A ``remove`` event is sent when a reading
+        is removed; its data is an object with the canonical ``link``
+        of the reading.  The event id is the version of the list
+        after the change.  A ``reset`` event means that events were
+        dropped and the list should be reloaded.
+
+        Only changes made through the process that holds the stream
+        are published, so reload the list when the stream reconnects.
+
+        :statuscode 200: the response is an event stream
+        :statuscode 302: you have not logged in.  The
+            :http:header:`Location` header will redirect to the login
+            page.
+
+        .. _server-sent events: https://www.w3.org/TR/eventsource/
+
+        """
+        user_id = self.current_user['id']
+        transcoder = transcoders.JSONTranscoder()
+        self.set_header('Content-Type', 'text/event-stream; charset="utf-8"')
+        self.set_header('Cache-Control', 'no-cache')
+        self.queue = self.application.events.subscribe(user_id)
+        try:
+            self.write('retry: 5000\n\n')
+            yield self.flush()
+            while True:
+                try:
+                    item = yield self.queue.get(timeout=datetime.timedelta(
+                        seconds=self.keepalive_interval))
+                except gen.TimeoutError:
+                    self.write(': keepalive\n\n')
+                else:
+                    if item is None:
+                        break
+                    event_type, data, event_id = item
+                    if event_id is not None:
+                        self.write('id: {}\n'.format(event_id))
+                    self.write('event: {}\ndata: {}\n\n'.format(
+                        event_type, transcoder.dumps(data)))
+                yield self.flush()
+        except iostream.StreamClosedError:
+            self.stream_closed = True
+        finally:
+            self.application.events.unsubscribe(user_id, self.queue)
+        if not self.stream_closed:
+            self.finish()
+
+    def on_connection_close(self):
+        super(EventsHandler, self).on_connection_close()
+        self.stream_closed = True
+        if self.queue is not None:
+            self.application.events.unsubscribe(self.current_user['id'],
+                                                self.queue)
+
+
+def get_added(doc):
+    """
+    Return when a reading was added as an aware datetime.
+
+    Imported readings keep their original ``added`` time while
+    ``when`` records when they were inserted.
+
+    """
+    return doc.get('added', doc['when']).replace(tzinfo=pytz.utc)
+
+
+def _csv_row(values):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
@@ -1,10 +1,96 @@
 from urllib import parse
+import base64
+import binascii
+import calendar
+import collections
+import datetime
+import inspect
 import logging
 import json
+import random
+import re
+import threading
 
 from motor import motor_tornado
+from sprockets.mixins.mediatype import content, transcoders
 from tornado import concurrent, gen, ioloop, web
+import bson.errors
+import bson.objectid
+import pymongo
+import pymongo.common
 import pymongo.errors
+import pymongo.monitoring
+import pymongo.write_concern
+
+
+READINGS_SORT = [('when', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+TOMBSTONE_TTL = datetime.timedelta(days=30)
+"""How long the tombstones of removed readings are retained."""
+
+INDEXES = {
+    'readings': [
+        pymongo.IndexModel([('user_id', pymongo.ASCENDING)] + READINGS_SORT,
+                           name='user_id_when_id'),
+        # equality, then sort, then range: the search query filters on
+        # term prefixes while the index supplies the READINGS_SORT order
+        pymongo.IndexModel([('user_id', pymongo.ASCENDING)] + READINGS_SORT +
+                           [('terms', pymongo.ASCENDING)],
+                           name='user_id_when_id_terms'),
+    ],
+    'tombstones': [
+        pymongo.IndexModel([('user_id', pymongo.ASCENDING),
+                            ('deleted', pymongo.ASCENDING)],
+                           name='user_id_deleted'),
+        pymongo.IndexModel(
+            [('deleted', pymongo.ASCENDING)], name='deleted_ttl',
+            expireAfterSeconds=int(TOMBSTONE_TTL.total_seconds())),
+    ],
+    'users': [
+        pymongo.IndexModel([('email', pymongo.ASCENDING)],
+                           name='email', unique=True),
+    ],
+}
+"""Indexes that :meth:`MongoClient.ensure_indexes` maintains."""
+
+_EXAMPLE_USER = '0' * 24
+CANONICAL_QUERIES = [
+    ('readings', {'user_id': _EXAMPLE_USER}, READINGS_SORT),
+    ('readings', {'user_id': _EXAMPLE_USER, '$or': [
+        {'when': {'$lt': datetime.datetime(1970, 1, 1)}},
+        {'when': datetime.datetime(1970, 1, 1),
+         '_id': {'$lt': bson.objectid.ObjectId(_EXAMPLE_USER)}}]},
+     READINGS_SORT),
+    ('readings', {'_id': bson.objectid.ObjectId(_EXAMPLE_USER),
+                  'user_id': _EXAMPLE_USER}, None),
+    ('readings', {'user_id': _EXAMPLE_USER,
+                  'when': {'$gt': datetime.datetime(1970, 1, 1)}},
+     READINGS_SORT),
+    ('readings', {'user_id': _EXAMPLE_USER,
+                  '$and': [{'terms': {'$regex': '^example'}}]},
+     READINGS_SORT),
+    ('tombstones', {'user_id': _EXAMPLE_USER,
+                    'deleted': {'$gt': datetime.datetime(1970, 1, 1)}}, None),
+    ('users', {'email': 'nobody@example.com'}, None),
+]
+"""Queries that :meth:`MongoClient.verify_indexes` explains."""
+
+READING_FIELDS = {'link': True, 'title': True, 'when': True, 'added': True}
+"""Projection of the reading fields that responses are built from."""
+
+SEARCH_FIELDS = dict(READING_FIELDS, terms=True)
+"""Projection of the reading fields that search results are ranked by."""
+
+IGNORED_TERMS = frozenset(['http', 'https', 'www'])
+"""Words that are too common in links to be worth indexing."""
+
+USER_FIELDS = {'readings_version': True}
+"""Projection of the user fields that authenticated requests use."""
+
+DUPLICATE_KEY = 11000
+"""Server error code for a unique index violation."""
+
+UNINDEXED_STAGES = frozenset(['COLLSCAN', 'SORT'])
 
 
 class AbsoluteReverseUrlMixin(web.RequestHandler):
@@ -30,7 +116,7 @@ class AJAXRedirectMixin(web.RequestHandler):
         if self.is_ajax_request():
             self.logger.debug('AJAXin redirect to %s', url)
             self.set_status(200)
-            if hasattr(self, 'send_response'):
+            if isinstance(self, content.ContentMixin):
                 self.send_response({'redirect': url, 'status': status})
             else:
                 self.set_header('Content-Type', 'application/json')
@@ -42,67 +128,261 @@ class AJAXRedirectMixin(web.RequestHandler):
                                                 status=status)
 
 
+class JSONArrayWriter(object):
+    """
+    Incrementally write a JSON array to a request handler.
+
+    :param tornado.web.RequestHandler handler: handler to write to
+    :param transcoder: JSON transcoder to serialize items with
+
+    Each call to :meth:`write_items` serializes a batch of items.
+    Flush the handler after each batch to send it to the client using
+    chunked transfer encoding so that the response is never buffered
+    in its entirety.
+
+    """
+
+    def __init__(self, handler, transcoder=None):
+        self.handler = handler
+        self.transcoder = transcoder or transcoders.JSONTranscoder()
+        self.encoding = self.transcoder.default_encoding
+        self.count = 0
+        self.started = False
+
+    def start(self):
+        self.handler.set_header('Content-Type', '{}; charset="{}"'.format(
+            self.transcoder.content_type, self.encoding))
+        self.handler.add_header('Vary', 'Accept')
+        self.handler.write(b'[')
+        self.started = True
+
+    def write_items(self, items):
+        if not self.started:
+            self.start()
+        if items:
+            # the transcoder is configured for compact separators so
+            # the array can be spliced by dropping the brackets
+            chunk = self.transcoder.dumps(items)[1:-1]
+            if self.count:
+                chunk = ',' + chunk
+            self.handler.write(chunk.encode(self.encoding))
+            self.count += len(items)
+
+    def finish(self):
+        if not self.started:
+            self.start()
+        self.handler.write(b']')
+        return self.handler.finish()
+
+
+class RecordReader(object):
+    """
+    Incrementally split a byte stream into newline-terminated records.
+
+    :param int max_length: number of bytes that a single record may
+        contain
+    :param bool quoted: if this is :data:`True`, then newlines inside
+        double-quoted fields do not end a record (as in CSV)
+
+    Each call to :meth:`feed` returns the ``(line_number, record)``
+    tuples that the chunk completed.  `record` is the decoded text
+    without the line terminator or a :exc:`ValueError` describing why
+    the record could not be read.  Only the incomplete trailing record
+    is buffered between calls.  Blank lines are skipped.
+
+    """
+
+    def __init__(self, max_length=64 * 1024, quoted=False):
+        self.max_length = max_length
+        self.quoted = quoted
+        self.line_number = 0
+        self.pending = b''
+        self.partial = b''
+        self.discarding = False
+
+    def feed(self, chunk):
+        records = []
+        lines = (self.pending + chunk).split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self._add_line(line + b'\n', records)
+        if len(self.partial) + len(self.pending) > self.max_length:
+            self._add_line(self.pending, records, complete=False)
+            self.pending = b''
+        return records
+
+    def close(self):
+        """Return the final record if it was not terminated."""
+        records = []
+        if self.pending:
+            self._add_line(self.pending, records)
+            self.pending = b''
+        if self.partial:
+            self.line_number += 1
+            records.append((self.line_number,
+                            ValueError('unterminated quoted field')))
+            self.partial = b''
+        return records
+
+    def _add_line(self, line, records, complete=True):
+        if self.discarding:
+            self.discarding = not complete
+            return
+        record = self.partial + line
+        if len(record) > self.max_length:
+            self.line_number += 1
+            self.partial = b''
+            self.discarding = not complete
+            records.append((self.line_number, ValueError(
+                'record exceeds {} bytes'.format(self.max_length))))
+            return
+        if self.quoted and record.count(b'"') % 2:
+            self.partial = record
+            return
+
+        self.partial = b''
+        self.line_number += 1
+        try:
+            text = record.decode('utf-8').rstrip('\r\n')
+        except UnicodeError:
+            records.append((self.line_number,
+                            ValueError('record is not UTF-8 encoded')))
+        else:
+            if text.strip():
+                records.append((self.line_number, text))
+
+
 class MongoActor(object):
+    """
+    A single MongoDB operation with bounded retries.
+
+    :param db: the Motor database to operate on
+    :param str collection: name of the collection to operate on
+    :param float timeout: number of seconds that the operation,
+        including any retries, is allowed to take.  :data:`None`
+        disables the deadline.
+    :param readings.metrics.Registry metrics: optional registry that
+        the duration, retries, and errors of the operation are
+        recorded in
+
+    Sub-classes implement :meth:`execute` as a native coroutine.  If
+    it fails with :exc:`pymongo.errors.AutoReconnect`, then the
+    operation is retried after an exponentially increasing, randomly
+    jittered delay as long as the operation is :attr:`idempotent`
+    and the deadline has not passed.
+
+    """
+
+    idempotent = True
+    """Can the operation be safely repeated after a network failure?"""
 
-    def __init__(self, db, collection):
+    max_attempts = 5
+    base_delay = 0.05
+    max_delay = 2.0
+
+    def __init__(self, db, collection, timeout=None, metrics=None):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.db = db
         self.collection = collection
-        self.retry_count = 0
-
-    def action(self):
-        raise NotImplementedError
+        self.timeout = timeout
+        self.metrics = metrics
+        self.attempts = 0
 
-    def on_complete(self, result):
+    async def execute(self):
         raise NotImplementedError
 
-    @gen.coroutine
-    def perform_operation(self):
-        coro = self.action()
-        iol = ioloop.IOLoop.instance()
-        future = concurrent.TracebackFuture()
+    def can_retry(self, error):
+        # NotMasterError means that the server refused the operation
+        # so it is safe to retry even if the operation is not idempotent
+        return (self.idempotent or
+                isinstance(error, pymongo.errors.NotMasterError))
 
-        def on_future_complete(f):
-            exc = f.exception()
-            if exc is not None:
-                future.set_exception(exc)
-            else:
-                maybe_future = self.on_complete(f.result())
-                if concurrent.is_future(maybe_future):
-                    iol.add_future(maybe_future, on_future_complete)
-                else:
-                    future.set_result(maybe_future)
+    def get_retry_delay(self, attempt):
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, ceiling)
 
-        iol.add_future(coro, on_future_complete)
+    async def perform_operation(self):
+        iol = ioloop.IOLoop.current()
+        start = iol.time()
         try:
-            res = yield future
-
-        except pymongo.errors.AutoReconnect as error:
-            if self.retry_count < 5:
-                self.logger.warning('mongo reconnecting, retrying operation, '
-                                    'attempt %d', self.retry_count)
-                self.retry_count += 1
-                res = yield self.perform_operation()
-            else:
-                self.logger.error('giving up on mongo connection - %r',
-                                  error)
-                raise error
+            result = await self._retry_until_deadline(iol)
+        except Exception as error:
+            self.record_metrics(iol.time() - start, error)
+            raise
+        self.record_metrics(iol.time() - start)
+        return result
+
+    def record_metrics(self, elapsed, error=None):
+        if self.metrics is None:
+            return
+        labels = (self.__class__.__name__, self.collection)
+        self.metrics.histogram(
+            'readings_mongo_operation_seconds',
+            'Duration of database operations including retries.',
+            ('operation', 'collection')).observe(labels, elapsed)
+        if self.attempts > 1:
+            self.metrics.counter(
+                'readings_mongo_retries_total',
+                'Retried attempts of database operations.',
+                ('operation', 'collection')).inc(labels, self.attempts - 1)
+        if error is not None:
+            self.metrics.counter(
+                'readings_mongo_errors_total',
+                'Database operations that failed.',
+                ('operation', 'collection', 'error')).inc(
+                    labels + (error.__class__.__name__,))
+
+    async def _retry_until_deadline(self, iol):
+        deadline = None if self.timeout is None else iol.time() + self.timeout
+        self.attempts = 0
+        while True:
+            self.attempts += 1
+            attempt = self.attempts
+            try:
+                if deadline is None:
+                    return await self.execute()
+                return await gen.with_timeout(
+                    deadline, gen.convert_yielded(self.execute()))
 
-        self.retry_count = 0
+            except gen.TimeoutError:
+                if deadline is not None:
+                    self.logger.error(
+                        '%s on %s did not complete within %.3fs',
+                        self.__class__.__name__, self.collection,
+                        self.timeout)
+                raise
 
-        raise gen.Return(res)
+            except pymongo.errors.AutoReconnect as error:
+                if attempt >= self.max_attempts or not self.can_retry(error):
+                    self.logger.error('giving up on mongo operation after %d '
+                                      'attempts - %r', attempt, error)
+                    raise
+
+                delay = self.get_retry_delay(attempt)
+                if deadline is not None and iol.time() + delay >= deadline:
+                    self.logger.error('giving up on mongo operation, deadline '
+                                      'reached after %d attempts - %r',
+                                      attempt, error)
+                    raise
+
+                self.logger.warning('mongo reconnecting, retrying operation '
+                                    'in %.3fs, attempt %d', delay, attempt)
+                await gen.sleep(delay)
 
 
 class FindOne(MongoActor):
 
-    def __init__(self, db, collection, query_spec):
-        super(FindOne, self).__init__(db, collection)
+    def __init__(self, db, collection, query_spec, projection=None,
+                 read_preference=None, **kwargs):
+        super(FindOne, self).__init__(db, collection, **kwargs)
         self.query_spec = query_spec
+        self.projection = projection
+        self.read_preference = read_preference
 
-    def action(self):
-        return self.db[self.collection].find_one(self.query_spec)
-
-    def on_complete(self, result):
+    async def execute(self):
+        result = await with_read_preference(
+            self.db[self.collection], self.read_preference).find_one(
+                self.query_spec, projection=self.projection)
         result_dict = dict(result or {})
         if '_id' in result_dict and 'id' not in result_dict:
             result_dict['id'] = str(result_dict['_id'])
@@ -111,69 +391,945 @@ class FindOne(MongoActor):
 
 class FindMany(MongoActor):
 
-    def __init__(self, db, collection, query_spec, *sort_spec):
-        super(FindMany, self).__init__(db, collection)
+    def __init__(self, db, collection, query_spec, *sort_spec,
+                 projection=None, limit=None, start_after=None,
+                 batch_size=None, on_batch=None, read_preference=None,
+                 fetch_timeout=None, **kwargs):
+        super(FindMany, self).__init__(db, collection, **kwargs)
         self.query_spec = query_spec
         self.sort_spec = sort_spec
-        self.cursor = None
-        self.results = []
+        self.projection = projection
+        self.limit = limit
+        self.start_after = start_after
+        self.batch_size = batch_size
+        self.on_batch = on_batch
+        self.read_preference = read_preference
+        self.fetch_timeout = fetch_timeout
+        self.delivered = 0
 
-    def action(self):
-        self.cursor = self.db[self.collection].find(self.query_spec)
+    async def execute(self):
+        query_spec = self.query_spec
+        if self.start_after is not None:
+            query_spec = build_range_query(query_spec,
+                                           normalize_sort(self.sort_spec),
+                                           self.start_after)
+        cursor = with_read_preference(
+            self.db[self.collection], self.read_preference).find(
+                query_spec, projection=self.projection)
         if self.sort_spec:
-            self.cursor = self.cursor.sort(*self.sort_spec)
-        return self.cursor.fetch_next
+            cursor = cursor.sort(*self.sort_spec)
+        if self.limit:
+            cursor = cursor.limit(self.limit)
+        if self.batch_size:
+            cursor = cursor.batch_size(self.batch_size)
+
+        results = []
+        batch = await self._fetch(cursor)
+        while batch:
+            if self.on_batch is None:
+                results.extend(batch)
+            else:
+                self.delivered += len(batch)
+                maybe_awaitable = self.on_batch(batch)
+                if inspect.isawaitable(maybe_awaitable):
+                    await maybe_awaitable
+            batch = await self._fetch(cursor)
+
+        return results if self.on_batch is None else self.delivered
+
+    async def _fetch(self, cursor):
+        if self.fetch_timeout is None:
+            return await cursor.to_list(self.batch_size)
+        try:
+            return await gen.with_timeout(
+                datetime.timedelta(seconds=self.fetch_timeout),
+                gen.convert_yielded(cursor.to_list(self.batch_size)))
+        except gen.TimeoutError:
+            self.logger.error('%s on %s did not fetch a batch within %.3fs',
+                              self.__class__.__name__, self.collection,
+                              self.fetch_timeout)
+            raise
+
+    def can_retry(self, error):
+        # once a batch has been handed off it cannot be taken back
+        return not self.delivered and super(FindMany, self).can_retry(error)
+
+
+class InsertMany(MongoActor):
+
+    idempotent = False
+
+    def __init__(self, db, collection, docs, ordered=True, **kwargs):
+        super(InsertMany, self).__init__(db, collection, **kwargs)
+        self.docs = [doc.copy() for doc in docs]
+        for doc in self.docs:
+            doc.setdefault('_id', bson.objectid.ObjectId())
+        self.ordered = ordered
+
+    async def execute(self):
+        await self.db[self.collection].insert_many(self.docs,
+                                                   ordered=self.ordered)
+        return [(str(doc['_id']), None) for doc in self.docs]
+
+    def describe_failure(self, error):
+        """
+        Translate a :exc:`pymongo.errors.BulkWriteError` into results.
+
+        :returns: a list of ``(doc_id, error)`` tuples in the same order
+            as the documents.  Documents that were not inserted have a
+            `doc_id` of :data:`None` and an `error` dictionary containing
+            the server's ``code`` and ``errmsg``.
+
+        """
+        errors = {write_error['index']: write_error
+                  for write_error in error.details.get('writeErrors', [])}
+        results = []
+        for index, doc in enumerate(self.docs):
+            if index in errors:
+                results.append((None, {'code': errors[index].get('code'),
+                                       'errmsg': errors[index].get('errmsg')}))
+            elif self.ordered and errors and index > min(errors):
+                results.append((None, {'code': None,
+                                       'errmsg': 'not attempted'}))
+            else:
+                results.append((str(doc['_id']), None))
+        return results
+
+
+class CoalescedInsert(InsertMany):
+    """
+    Unordered insert of documents from concurrent callers.
+
+    Every document is given its ``_id`` before the first attempt, so a
+    duplicate key error on a retry means that the earlier attempt
+    inserted the document.  That makes the operation safe to repeat.
+
+    """
+
+    idempotent = True
+
+    def __init__(self, db, collection, docs, **kwargs):
+        super(CoalescedInsert, self).__init__(db, collection, docs,
+                                              ordered=False, **kwargs)
+
+    def describe_failure(self, error):
+        results = super(CoalescedInsert, self).describe_failure(error)
+        if self.attempts > 1:
+            results = [(str(doc['_id']), None)
+                       if failure and failure['code'] == DUPLICATE_KEY
+                       else (doc_id, failure)
+                       for doc, (doc_id, failure) in zip(self.docs, results)]
+        return results
+
+
+class RemoveOne(MongoActor):
+
+    # a retry cannot tell whether the first attempt removed the document
+    idempotent = False
+
+    def __init__(self, db, collection, query_spec, projection=None,
+                 **kwargs):
+        super(RemoveOne, self).__init__(db, collection, **kwargs)
+        self.query_spec = query_spec
+        self.projection = projection
+
+    async def execute(self):
+        result = await self.db[self.collection].find_one_and_delete(
+            self.query_spec, projection=self.projection)
+        return dict(result or {})
+
+
+class DeleteMany(MongoActor):
+
+    def __init__(self, db, collection, query_spec, **kwargs):
+        super(DeleteMany, self).__init__(db, collection, **kwargs)
+        self.query_spec = query_spec
+
+    async def execute(self):
+        result = await self.db[self.collection].delete_many(self.query_spec)
+        return result.deleted_count
+
+
+class UpdateFields(MongoActor):
+
+    def __init__(self, db, collection, query_spec, fields, **kwargs):
+        super(UpdateFields, self).__init__(db, collection, **kwargs)
+        self.query_spec = query_spec
+        self.fields = fields
+
+    async def execute(self):
+        result = await self.db[self.collection].update_one(
+            self.query_spec, {'$set': self.fields})
+        return result.matched_count
+
+
+class IncrementField(MongoActor):
+
+    idempotent = False
+
+    def __init__(self, db, collection, query_spec, field, **kwargs):
+        super(IncrementField, self).__init__(db, collection, **kwargs)
+        self.query_spec = query_spec
+        self.field = field
+
+    async def execute(self):
+        result = await self.db[self.collection].find_one_and_update(
+            self.query_spec, {'$inc': {self.field: 1}},
+            projection={self.field: True},
+            return_document=pymongo.ReturnDocument.AFTER)
+        return (result or {}).get(self.field, 0)
+
+
+class Ping(MongoActor):
+    """Round trip to the server without touching a collection."""
+
+    def __init__(self, db, **kwargs):
+        super(Ping, self).__init__(db, '$cmd', **kwargs)
+
+    async def execute(self):
+        await self.db.command('ping')
+        return True
+
+
+class PoolMonitor(pymongo.monitoring.CommandListener):
+    """
+    Track how much of the connection pool is in use.
+
+    :param int max_pool_size: maximum size of the connection pool
+
+    An instance is registered as an event listener on the driver so
+    that every command that is sent to the server is counted while it
+    holds a connection.  :class:`MongoClient` additionally reports
+    the operations that it starts so that the number of operations
+    that are *not* holding a connection -- either waiting for one
+    or between round trips -- is visible as well.
+
+    The driver calls the listener methods from its worker threads so
+    the counters are protected by a lock.
+
+    """
+
+    def __init__(self, max_pool_size=pymongo.common.MAX_POOL_SIZE):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.max_pool_size = max_pool_size
+        self.operations = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.commands = 0
+        self.failures = 0
+        self.checkout_failures = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._lock = threading.Lock()
+
+    def operation_started(self):
+        with self._lock:
+            self.operations += 1
+
+    def operation_finished(self, error=None):
+        with self._lock:
+            self.operations -= 1
+            # the driver raises these instead of sending a command when
+            # it cannot get a connection from the pool in time
+            if (isinstance(error, pymongo.errors.ExceededMaxWaiters) or
+                    (isinstance(error, pymongo.errors.ConnectionFailure) and
+                     not isinstance(error, pymongo.errors.AutoReconnect))):
+                self.checkout_failures += 1
+
+    def started(self, event):
+        with self._lock:
+            self.in_flight += 1
+            self.commands += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            saturated = self.in_flight == self.max_pool_size
+        if saturated:
+            self.logger.warning('all %d pooled connections are in use',
+                                self.max_pool_size)
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        with self._lock:
+            self.failures += 1
+        self._finished(event)
+
+    def _finished(self, event):
+        elapsed = event.duration_micros / 1e6
+        with self._lock:
+            self.in_flight = max(self.in_flight - 1, 0)
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_pool_size': self.max_pool_size,
+                'operations': self.operations,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'waiting': max(self.operations - self.in_flight, 0),
+                'commands': self.commands,
+                'failures': self.failures,
+                'checkout_failures': self.checkout_failures,
+                'mean_time': (self.total_time / self.commands
+                              if self.commands else 0.0),
+                'max_time': self.max_time,
+            }
+
+
+class InsertCoalescer(object):
+    """
+    Combine concurrent single-document inserts into batches.
+
+    :param MongoClient client: the client that writes the batches
+    :param float max_delay: number of seconds that the first document
+        in a batch waits for company
+    :param int max_size: number of documents that causes a batch to
+        be written without waiting
+
+    :meth:`insert` queues a document and returns a future.  A batch is
+    written as one unordered ``insert_many`` when it is `max_size`
+    documents long or `max_delay` seconds after it was started,
+    whichever happens first.  Each future resolves to the ``_id`` of
+    its own document or fails with the
+    :exc:`~pymongo.errors.WriteError` that the server reported for it.
+    A failure of the whole batch fails every future in it.
 
-    def on_complete(self, result):
-        if result:
-            self.results.append(self.cursor.next_object())
-            return self.cursor.fetch_next
-        return self.results
+    """
 
+    def __init__(self, client, max_delay=0.002, max_size=100):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.client = client
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.pending = collections.defaultdict(list)
+        self._timeouts = {}
 
-class SaveDocument(MongoActor):
+    def insert(self, collection, doc):
+        doc = doc.copy()
+        doc.setdefault('_id', bson.objectid.ObjectId())
+        future = concurrent.Future()
+        batch = self.pending[collection]
+        batch.append((doc, future))
+        if len(batch) >= self.max_size:
+            self.flush(collection)
+        elif collection not in self._timeouts:
+            iol = ioloop.IOLoop.current()
+            self._timeouts[collection] = (iol, iol.call_later(
+                self.max_delay, self.flush, collection))
+        return future
 
-    def __init__(self, db, collection, doc):
-        super(SaveDocument, self).__init__(db, collection)
-        self.doc = doc.copy()
+    def flush(self, collection):
+        """Start writing the pending batch for `collection`."""
+        try:
+            iol, timeout = self._timeouts.pop(collection)
+        except KeyError:
+            iol = ioloop.IOLoop.current()
+        else:
+            iol.remove_timeout(timeout)
+        batch = self.pending.pop(collection, None)
+        if batch:
+            iol.spawn_callback(self._write, collection, batch)
 
-    def action(self):
-        return self.db[self.collection].save(self.doc)
+    async def _write(self, collection, batch):
+        actor = CoalescedInsert(self.client.database, collection,
+                                [doc for doc, _ in batch],
+                                timeout=self.client.operation_timeout)
+        if self.client.metrics is not None:
+            self.client.metrics.histogram(
+                'readings_mongo_insert_batch_size',
+                'Number of documents written by each coalesced insert.',
+                ('collection',), buckets=(1, 2, 5, 10, 25, 50, 100, 250),
+            ).observe((collection,), len(batch))
+        try:
+            try:
+                results = await self.client._perform(actor)
+            except pymongo.errors.BulkWriteError as error:
+                results = actor.describe_failure(error)
+        except Exception as error:
+            self.logger.error('failed to insert %d documents into %s - %r',
+                              len(batch), collection, error)
+            for _, future in batch:
+                future.set_exception(error)
+            return
 
-    def on_complete(self, result):
-        return str(result)
+        for (_, future), (doc_id, failure) in zip(batch, results):
+            if failure is None:
+                future.set_result(doc_id)
+            elif failure['code'] == DUPLICATE_KEY:
+                future.set_exception(pymongo.errors.DuplicateKeyError(
+                    failure['errmsg'], failure['code']))
+            else:
+                future.set_exception(pymongo.errors.WriteError(
+                    failure['errmsg'], failure['code']))
 
 
 class MongoClient(object):
+    """
+    Asynchronous access to the readings database.
+
+    :param float operation_timeout: number of seconds that an
+        operation, including retries, is allowed to take
+    :param dict pool_options: additional keyword parameters for the
+        driver such as ``maxPoolSize`` or ``socketTimeoutMS``
+    :param readings.metrics.Registry metrics: optional registry that
+        operation timings are recorded in
+    :param dict write_concern: optional ``w``, ``j``, and ``wtimeout``
+        values for the :class:`~pymongo.write_concern.WriteConcern`
+        that every write uses.  The server default is used otherwise.
+    :param dict insert_options: keyword parameters for the
+        :class:`InsertCoalescer` behind :meth:`insert`
+    :param read_preference: optional
+        :mod:`~pymongo.read_preferences` instance that reads use
+        unless one is passed to :meth:`find` or :meth:`find_one`.
+        Reads go to the primary otherwise.
+    :param client: optional Motor client to use instead of connecting
+
+    The connection is described either by `url` or by the individual
+    `host`, `port`, `user`, `password`, and `database` parameters.
+    Alternatively, an existing `client` can be passed to share it or
+    to substitute a stand-in such as the one that the benchmarks use.
+    Connection pool usage is available from :meth:`pool_stats`.
+
+    """
 
     def __init__(self, host=None, port=None, user=None, password=None,
-                 database=None, url=None):
+                 database=None, url=None, operation_timeout=10.0,
+                 pool_options=None, metrics=None, write_concern=None,
+                 insert_options=None, read_preference=None, client=None):
         super(MongoClient, self).__init__()
         self.logger = logging.getLogger(__name__)
-        if url is not None:
-            dsn = url
-        else:
-            dsn = 'mongodb://{user}:{password}@{host}:{port}/{db}'.format(
-                user=parse.quote(user, safe=''),
-                password=parse.quote(password, safe=''),
-                host=host, port=port, db=parse.quote(database, safe=''))
-        self.mongo = motor_tornado.MotorClient(dsn)
-
-    @gen.coroutine
-    def find_one(self, collection, query_spec):
-        actor = FindOne(self.mongo.readings, collection, query_spec)
-        doc = yield actor.perform_operation()
-        raise gen.Return(doc)
-
-    @gen.coroutine
-    def find(self, collection, query_spec, *sort_spec):
-        actor = FindMany(self.mongo.readings, collection,
-                         query_spec, *sort_spec)
-        results = yield actor.perform_operation()
-        raise gen.Return(results)
-
-    @gen.coroutine
-    def save(self, collection, doc):
-        actor = SaveDocument(self.mongo.readings, collection, doc)
-        doc_id = yield actor.perform_operation()
-        raise gen.Return(doc_id)
+        pool_options = dict(pool_options or {})
+        self.pool_monitor = PoolMonitor(pool_options.get(
+            'maxPoolSize', pymongo.common.MAX_POOL_SIZE))
+        if client is None:
+            if url is not None:
+                dsn = url
+            else:
+                dsn = 'mongodb://{user}:{password}@{host}:{port}/{db}'.format(
+                    user=parse.quote(user, safe=''),
+                    password=parse.quote(password, safe=''),
+                    host=host, port=port, db=parse.quote(database, safe=''))
+            client = motor_tornado.MotorClient(
+                dsn, event_listeners=[self.pool_monitor], **pool_options)
+        self.mongo = client
+        self.database = client.get_database(
+            'readings', write_concern=pymongo.write_concern.WriteConcern(
+                **(write_concern or {})), read_preference=read_preference)
+        self.operation_timeout = operation_timeout
+        self.metrics = metrics
+        self.coalescer = InsertCoalescer(self, **(insert_options or {}))
+
+    def pool_stats(self):
+        """Return the connection pool counters as a :class:`dict`."""
+        return self.pool_monitor.stats()
+
+    async def _perform(self, actor):
+        if actor.metrics is None:
+            actor.metrics = self.metrics
+        self.pool_monitor.operation_started()
+        try:
+            result = await actor.perform_operation()
+        except Exception as error:
+            self.pool_monitor.operation_finished(error)
+            raise
+        self.pool_monitor.operation_finished()
+        return result
+
+    async def find_one(self, collection, query_spec, projection=None,
+                       read_preference=None):
+        """
+        Find a single document matching `query_spec`.
+
+        :param str collection: name of the collection to search
+        :param query_spec: query document or the ``_id`` to find
+        :param dict projection: optional projection that limits the
+            fields that are returned.  ``_id`` is always included.
+        :param read_preference: optional read preference that overrides
+            the client's for this query
+        :returns: the document with an additional ``id`` field that
+            contains the string form of ``_id`` or an empty
+            :class:`dict` if nothing matched
+
+        """
+        actor = FindOne(self.database, collection, query_spec,
+                        projection=projection,
+                        read_preference=read_preference,
+                        timeout=self.operation_timeout)
+        return await self._perform(actor)
+
+    async def find(self, collection, query_spec, *sort_spec, projection=None,
+                   limit=None, start_after=None, batch_size=None,
+                   on_batch=None, read_preference=None):
+        """
+        Find documents matching `query_spec`.
+
+        :param str collection: collection to search
+        :param dict query_spec: the query to run
+        :param sort_spec: passed to ``cursor.sort``
+        :param dict projection: optional projection that limits the
+            fields that are returned.  Include the sort keys if the
+            results are used to build a `start_after` value.
+        :param int limit: maximum number of documents to return
+        :param tuple start_after: sort key values of the last document
+            on the previous page (see :func:`build_range_query`)
+        :param int batch_size: number of documents to fetch per round
+            trip.  By default, the entire result set is retrieved.
+        :param on_batch: optional callable that is invoked with each
+            batch of documents.  If it returns an awaitable, the next
+            batch is not fetched until it resolves.
+        :param read_preference: optional read preference that overrides
+            the client's for this query
+        :returns: the list of documents or the number of documents
+            passed to `on_batch` if it is specified
+
+        Passing `on_batch` enables *streaming mode* where documents
+        are not accumulated in memory.  Since the pace of a stream is
+        set by `on_batch`, the operation timeout applies to fetching
+        each batch rather than to the whole operation.
+
+        """
+        actor = FindMany(self.database, collection, query_spec,
+                         *sort_spec, projection=projection, limit=limit,
+                         start_after=start_after,
+                         batch_size=batch_size, on_batch=on_batch,
+                         read_preference=read_preference,
+                         timeout=(self.operation_timeout if on_batch is None
+                                  else None),
+                         fetch_timeout=(None if on_batch is None
+                                        else self.operation_timeout))
+        return await self._perform(actor)
+
+    def insert(self, collection, doc):
+        """
+        Insert a single document alongside concurrent inserts.
+
+        :param str collection: collection to insert into
+        :param dict doc: the document to insert
+        :returns: a future that resolves to the string form of the new
+            document's ``_id``
+
+        The document is written together with the other documents
+        inserted into `collection` at about the same time (see
+        :class:`InsertCoalescer`).  A duplicate ``_id`` fails with
+        :exc:`pymongo.errors.DuplicateKeyError`.
+
+        """
+        return self.coalescer.insert(collection, doc)
+
+    async def insert_many(self, collection, docs, ordered=True,
+                          batch_size=500):
+        """
+        Insert `docs` using as few round trips as possible.
+
+        :param str collection: collection to insert into
+        :param list docs: documents to insert
+        :param bool ordered: if this is :data:`True`, then insertion
+            stops at the first failure.  Otherwise, every document is
+            attempted.
+        :param int batch_size: maximum number of documents to send in
+            a single ``insert_many`` call
+        :returns: a list of ``(doc_id, error)`` tuples with one entry
+            per document (see :meth:`InsertMany.describe_failure`)
+
+        """
+        results = []
+        for start in range(0, len(docs), batch_size):
+            actor = InsertMany(self.database, collection,
+                               docs[start:start + batch_size],
+                               ordered=ordered,
+                               timeout=self.operation_timeout)
+            try:
+                batch_results = await self._perform(actor)
+            except pymongo.errors.BulkWriteError as error:
+                batch_results = actor.describe_failure(error)
+            results.extend(batch_results)
+            if ordered and any(error for _, error in batch_results):
+                skipped = len(docs) - len(results)
+                results.extend([(None, {'code': None,
+                                        'errmsg': 'not attempted'})] * skipped)
+                break
+        return results
+
+    async def remove_one(self, collection, query_spec, projection=None):
+        """
+        Remove the document matching `query_spec`.
+
+        :param dict projection: optional projection that limits the
+            fields of the removed document that are returned
+        :returns: the removed document or an empty :class:`dict` if
+            nothing matched
+
+        """
+        actor = RemoveOne(self.database, collection, query_spec,
+                          projection=projection,
+                          timeout=self.operation_timeout)
+        return await self._perform(actor)
+
+    async def delete_many(self, collection, query_spec):
+        """
+        Remove every document matching `query_spec`.
+
+        :returns: the number of documents that were removed
+
+        """
+        actor = DeleteMany(self.database, collection, query_spec,
+                           timeout=self.operation_timeout)
+        return await self._perform(actor)
+
+    async def update(self, collection, query_spec, fields):
+        """
+        Set `fields` in the document matching `query_spec`.
+
+        :returns: the number of documents that matched
+
+        """
+        actor = UpdateFields(self.database, collection, query_spec, fields,
+                             timeout=self.operation_timeout)
+        return await self._perform(actor)
+
+    async def increment(self, collection, query_spec, field):
+        """
+        Atomically increment `field` in the document matching `query_spec`.
+
+        :returns: the new value of `field` or zero if there was no
+            matching document
+
+        """
+        actor = IncrementField(self.database, collection,
+                               query_spec, field,
+                               timeout=self.operation_timeout)
+        return await self._perform(actor)
+
+    async def ping(self, timeout=None):
+        """
+        Check that the server is reachable.
+
+        :param float timeout: optional number of seconds to wait instead
+            of the operation timeout
+        :raises pymongo.errors.PyMongoError: if the server cannot be
+            reached in time
+
+        """
+        actor = Ping(self.database, timeout=timeout or self.operation_timeout)
+        return await self._perform(actor)
+
+    async def warm_up(self, connections=1):
+        """
+        Connect to the server before the first request needs it.
+
+        :param int connections: number of pooled connections to open
+
+        The server is pinged over `connections` connections at once so
+        that name resolution, connecting, authentication, and server
+        selection are paid for up front instead of by the first
+        requests.  The pool keeps the connections open unless they
+        exceed its ``maxIdleTimeMS``.
+
+        """
+        await self.ping()
+        if connections > 1:
+            await gen.multi([self.ping() for _ in range(connections)])
+
+    async def ensure_indexes(self, indexes=None):
+        """
+        Create the declared indexes if they do not exist.
+
+        :param dict indexes: mapping of collection name to a list of
+            :class:`pymongo.IndexModel` instances.  Defaults to
+            :data:`INDEXES`.
+
+        Indexes that exist on the server but are not declared are
+        reported but left in place.
+
+        """
+        indexes = INDEXES if indexes is None else indexes
+        for collection, models in sorted(indexes.items()):
+            coll = self.database[collection]
+            names = await coll.create_indexes(models)
+            self.logger.info('ensured indexes %s on %s',
+                             ', '.join(names), collection)
+            existing = await coll.index_information()
+            undeclared = set(existing) - set(names) - {'_id_'}
+            if undeclared:
+                self.logger.info('undeclared indexes on %s: %s', collection,
+                                 ', '.join(sorted(undeclared)))
+
+    async def verify_indexes(self, queries=None):
+        """
+        Explain each canonical query and report those not using an index.
+
+        :param list queries: ``(collection, query_spec, sort_spec)``
+            tuples to explain.  Defaults to :data:`CANONICAL_QUERIES`.
+        :returns: :class:`list` of ``(collection, query_spec, stages)``
+            tuples for each query whose winning plan includes a
+            collection scan or an in-memory sort
+        :rtype: list
+
+        """
+        queries = CANONICAL_QUERIES if queries is None else queries
+        failures = []
+        for collection, query_spec, sort_spec in queries:
+            cursor = self.database[collection].find(query_spec)
+            if sort_spec:
+                cursor = cursor.sort(sort_spec)
+            explanation = await cursor.explain()
+            stages = set(plan_stages(
+                explanation['queryPlanner']['winningPlan']))
+            bad_stages = stages & UNINDEXED_STAGES
+            if bad_stages:
+                self.logger.warning('query on %s is not index-backed (%s): '
+                                    '%r', collection,
+                                    ', '.join(sorted(bad_stages)), query_spec)
+                failures.append((collection, query_spec, bad_stages))
+            else:
+                self.logger.debug('query on %s uses %s', collection,
+                                  ', '.join(sorted(stages)))
+        return failures
+
+
+def with_read_preference(collection, read_preference):
+    """Return `collection` with `read_preference` if one is given."""
+    if read_preference is None:
+        return collection
+    return collection.with_options(read_preference=read_preference)
+
+
+def normalize_sort(sort_spec):
+    """
+    Convert a ``cursor.sort`` argument list into ``(key, direction)`` pairs.
+
+    :param tuple sort_spec: either ``(key, direction)`` or a single
+        list of ``(key, direction)`` pairs
+    :rtype: list
+
+    """
+    if not sort_spec:
+        return []
+    if len(sort_spec) == 1:
+        return list(sort_spec[0])
+    return [(sort_spec[0], sort_spec[1])]
+
+
+def build_range_query(query_spec, sort_keys, start_after):
+    """
+    Restrict `query_spec` to documents that sort after `start_after`.
+
+    :param dict query_spec: the base query
+    :param list sort_keys: ``(key, direction)`` pairs that the cursor
+        is sorted by
+    :param tuple start_after: values of the sort keys for the last
+        document that was returned
+    :rtype: dict
+
+    This implements *keyset pagination* -- each page is selected by
+    a range over the (indexed) sort keys so the server never has to
+    skip over earlier pages.
+
+    """
+    clauses = []
+    for idx, (key, direction) in enumerate(sort_keys):
+        clause = {prev_key: value for (prev_key, _), value
+                  in zip(sort_keys[:idx], start_after[:idx])}
+        op = '$lt' if direction == pymongo.DESCENDING else '$gt'
+        clause[key] = {op: start_after[idx]}
+        clauses.append(clause)
+
+    query = dict(query_spec)
+    if '$or' in query:
+        query = {'$and': [query, {'$or': clauses}]}
+    else:
+        query['$or'] = clauses
+    return query
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encode_page_token(when, doc_id):
+    """
+    Generate an opaque continuation token for a ``(when, _id)`` key.
+
+    :param datetime.datetime when: naive UTC timestamp
+    :param bson.objectid.ObjectId doc_id: document identifier
+    :rtype: str
+
+    """
+    millis = (calendar.timegm(when.utctimetuple()) * 1000 +
+              when.microsecond // 1000)
+    raw = '{}:{}'.format(millis, doc_id).encode('ASCII')
+    return base64.urlsafe_b64encode(raw).decode('ASCII').rstrip('=')
+
+
+def decode_page_token(token):
+    """
+    Reverse :func:`encode_page_token`.
+
+    :param str token: token from a previous response
+    :returns: :class:`tuple` of the timestamp and object id
+    :raises ValueError: if `token` is malformed
+
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ASCII')).decode('ASCII')
+        millis, _, doc_id = raw.partition(':')
+        when = _EPOCH + datetime.timedelta(milliseconds=int(millis))
+        return when, bson.objectid.ObjectId(doc_id)
+    except (binascii.Error, UnicodeError, ValueError, OverflowError,
+            bson.errors.InvalidId) as error:
+        raise ValueError('invalid page token {!r}'.format(token)) from error
+
+
+def encode_sync_token(when):
+    """
+    Generate an opaque token that identifies a point in time.
+
+    :param datetime.datetime when: naive UTC timestamp
+    :rtype: str
+
+    """
+    millis = (calendar.timegm(when.utctimetuple()) * 1000 +
+              when.microsecond // 1000)
+    raw = 'sync:{}'.format(millis).encode('ASCII')
+    return base64.urlsafe_b64encode(raw).decode('ASCII').rstrip('=')
+
+
+def decode_sync_token(token):
+    """
+    Reverse :func:`encode_sync_token`.
+
+    :param str token: token from a previous response
+    :rtype: datetime.datetime
+    :raises ValueError: if `token` is malformed
+
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode('ASCII')).decode('ASCII')
+        prefix, _, millis = raw.partition(':')
+        if prefix != 'sync':
+            raise ValueError(prefix)
+        return _EPOCH + datetime.timedelta(milliseconds=int(millis))
+    except (binascii.Error, UnicodeError, ValueError,
+            OverflowError) as error:
+        raise ValueError('invalid sync token {!r}'.format(token)) from error
+
+
+_TIMESTAMP_PATTERN = re.compile(
+    r'^(?P<base>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?P<fraction>\.\d+)?'
+    r'(?:Z|(?P<sign>[-+])(?P<hours>\d\d):?(?P<minutes>\d\d))?$')
+
+
+def parse_timestamp(value):
+    """
+    Parse an ISO-8601 timestamp such as the ``added`` value of a reading.
+
+    :param str value: timestamp with an optional fraction of a second
+        and time zone offset.  UTC is assumed if the offset is omitted.
+    :returns: the naive UTC :class:`datetime.datetime`
+    :raises ValueError: if `value` is not a timestamp
+
+    """
+    match = _TIMESTAMP_PATTERN.match(value)
+    if match is None:
+        raise ValueError('invalid timestamp {!r}'.format(value))
+    when = datetime.datetime.strptime(match.group('base'),
+                                      '%Y-%m-%dT%H:%M:%S')
+    if match.group('fraction'):
+        when += datetime.timedelta(
+            microseconds=int(match.group('fraction')[1:7].ljust(6, '0')))
+    if match.group('sign'):
+        offset = datetime.timedelta(hours=int(match.group('hours')),
+                                    minutes=int(match.group('minutes')))
+        when += -offset if match.group('sign') == '+' else offset
+    return when
+
+
+def plan_stages(plan):
+    """Generate the stage names in an ``explain`` query plan tree."""
+    yield plan['stage']
+    for key in ('inputStage', 'outerStage', 'innerStage'):
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from plan_stages(child)
+
+
+_WORD_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """
+    Split `text` into lower-cased words for searching.
+
+    :param str text: the text to split
+    :rtype: list
+
+    Words in :data:`IGNORED_TERMS` are omitted.
+
+    """
+    return [word for word in _WORD_PATTERN.findall(text.lower())
+            if word not in IGNORED_TERMS]
+
+
+def search_terms(title, link):
+    """
+    Generate the indexed search terms of a reading.
+
+    :param str title: the reading's title
+    :param str link: the reading's external link
+    :returns: sorted :class:`list` of the distinct words in both
+
+    """
+    return sorted(set(tokenize(title)) | set(tokenize(link)))
+
+
+def build_search_query(user_id, words):
+    """
+    Build a query for readings whose terms start with each of `words`.
+
+    Each word becomes an anchored regular expression so that only the
+    index keys of the ``user_id_when_id_terms`` index that share the
+    prefix are fetched.  The index also supplies the
+    :data:`READINGS_SORT` order so the newest matches are found
+    without sorting in memory.
+
+    """
+    return {'user_id': user_id,
+            '$and': [{'terms': {'$regex': '^' + re.escape(word)}}
+                     for word in words]}
+
+
+def rank_readings(docs, words):
+    """
+    Order search results by how well they match `words`.
+
+    :param list docs: readings matching :func:`build_search_query`
+        including the fields in :data:`SEARCH_FIELDS`
+    :param list words: the tokenized search words
+    :returns: a new :class:`list` of `docs` with the best matches
+        first
+
+    A word that matches a whole term scores higher than one that only
+    matches the start of a term, and matches in the title count twice
+    as much as matches that only appear in the link.  Readings that
+    score the same keep their original order.
+
+    """
+    def score(doc):
+        title_words = set(tokenize(doc.get('title', '')))
+        terms = set(doc.get('terms', ())) | title_words
+        total = 0
+        for word in words:
+            for candidates, weight in ((title_words, 2), (terms, 1)):
+                if word in candidates:
+                    total += 2 * weight
+                    break
+                if any(term.startswith(word) for term in candidates):
+                    total += weight
+                    break
+        return total
+
+    return sorted(docs, key=score, reverse=True)
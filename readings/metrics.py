@@ -0,0 +1,217 @@
+import bisect
+import collections
+import logging
+
+from tornado import ioloop
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+"""Histogram bucket boundaries in seconds."""
+
+
+class _Metric(object):
+
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+    def format_labels(self, labels, **extra):
+        pairs = list(zip(self.label_names, labels)) + sorted(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                              for name, value in pairs) + '}'
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        yield '# HELP {} {}'.format(self.name, self.documentation)
+        yield '# TYPE {} {}'.format(self.name, self.kind)
+        for name, labels, value in self.samples():
+            yield '{}{} {}'.format(name, labels, _format_value(value))
+
+
+class Counter(_Metric):
+    """A value that only increases."""
+
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super(Counter, self).__init__(*args, **kwargs)
+        self.values = collections.defaultdict(float)
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] += amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, self.format_labels(labels), value
+
+
+class Gauge(_Metric):
+    """A value that is set to the current measurement."""
+
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super(Gauge, self).__init__(*args, **kwargs)
+        self.values = {}
+
+    def set(self, labels=(), value=0):
+        self.values[labels] = value
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, self.format_labels(labels), value
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values.
+
+    :param tuple buckets: upper bounds of the buckets in ascending
+        order.  The implicit ``+Inf`` bucket is added when rendering.
+
+    Each observation increments a single bucket counter; the
+    cumulative counts that Prometheus expects are computed when the
+    histogram is rendered.
+
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        self.counts = {}
+        self.sums = collections.defaultdict(float)
+
+    def observe(self, labels, value):
+        try:
+            counts = self.counts[labels]
+        except KeyError:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def samples(self):
+        for labels, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield (self.name + '_bucket',
+                       self.format_labels(labels, le=_format_value(bound)),
+                       total)
+            yield self.name + '_sum', self.format_labels(labels), \
+                self.sums[labels]
+            yield self.name + '_count', self.format_labels(labels), total
+
+
+class Registry(object):
+    """
+    Collection of metrics that is rendered by the metrics endpoint.
+
+    Metrics are created on first use by :meth:`counter`,
+    :meth:`gauge`, and :meth:`histogram` and shared afterwards.
+
+    Metrics are only updated from the IOLoop thread so they are not
+    protected by locks -- recording an observation is a couple of
+    dictionary operations.  Each process maintains its own registry.
+
+    """
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        try:
+            return self.metrics[name]
+        except KeyError:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._get_or_create(Counter, name, documentation, label_names)
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._get_or_create(Gauge, name, documentation, label_names)
+
+    def histogram(self, name, documentation, label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation,
+                                   label_names, buckets=buckets)
+
+    def render(self):
+        """Generate the Prometheus text exposition of every metric."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class LoopLagMonitor(object):
+    """
+    Measure how late the IOLoop runs scheduled callbacks.
+
+    :param Registry registry: where the measurements are recorded
+    :param float interval: number of seconds between measurements
+
+    A callback is scheduled every `interval` seconds and the
+    difference between when it was due and when it actually ran is
+    recorded.  A busy or blocked IOLoop shows up as increasing lag.
+
+    """
+
+    def __init__(self, registry, interval=0.5):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.interval = interval
+        self.histogram = registry.histogram(
+            'readings_event_loop_lag_seconds',
+            'Delay between when a callback was due and when it ran.',
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+        self.gauge = registry.gauge(
+            'readings_event_loop_lag_last_seconds',
+            'Most recently measured event loop lag.')
+        self._timeout = None
+        self._due = None
+
+    def start(self, iol=None):
+        iol = iol or ioloop.IOLoop.current()
+        self._schedule(iol)
+
+    def stop(self, iol=None):
+        if self._timeout is not None:
+            (iol or ioloop.IOLoop.current()).remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self, iol):
+        self._due = iol.time() + self.interval
+        self._timeout = iol.call_at(self._due, self._measure, iol)
+
+    def _measure(self, iol):
+        lag = max(iol.time() - self._due, 0.0)
+        self.histogram.observe((), lag)
+        self.gauge.set((), lag)
+        if lag > 1.0:
+            self.logger.warning('event loop lagging by %.3fs', lag)
+        self._schedule(iol)
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _format_value(value):
+    if isinstance(value, str):
+        return value
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
@@ -0,0 +1,179 @@
+import logging
+import os
+import random
+import signal
+import sys
+import time
+
+from sprockets.http import runner
+from tornado import httpserver, ioloop, netutil, process
+
+
+class Runner(runner.Runner):
+    """
+    HTTP service runner that optionally pre-forks worker processes.
+
+    :param tornado.web.Application application: the application to serve
+
+    The listening socket is bound first, but connections are only
+    accepted once the *before_run* callbacks have completed so that
+    requests do not arrive while the database is warmed up and the
+    indexes are prepared.
+
+    When more than one worker is requested, the listening socket is
+    bound in the parent process and then shared by each forked worker.
+    The parent process supervises the workers -- if a worker dies
+    unexpectedly, then it is replaced after a delay that increases
+    with the number of recent failures.  ``SIGTERM`` and ``SIGINT``
+    are forwarded to the workers which stop accepting connections and
+    drain in-flight requests before exiting.
+
+    The application should not create resources that cannot be shared
+    across processes (e.g., database connections, the IOLoop) until
+    the *before_run* callbacks are invoked in each worker.
+
+    """
+
+    max_restart_delay = 30.0
+
+    def __init__(self, *args, **kwargs):
+        super(Runner, self).__init__(*args, **kwargs)
+        self.logger = logging.getLogger('Runner')
+        self.sockets = None
+        self.workers = {}
+        self.stopping = False
+        self.restart_delay = 0.0
+
+    def start_server(self, port_number, number_of_procs=1):
+        if self.sockets is None:
+            super(Runner, self).start_server(port_number, number_of_procs)
+            return
+
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        xheaders = self.application.settings.get('xheaders', False)
+        self.server = httpserver.HTTPServer(self.application,
+                                            xheaders=xheaders)
+        self.server.add_sockets(self.sockets)
+        self.logger.info('worker %d serving on port %d', os.getpid(),
+                         port_number)
+
+    def run(self, port_number, number_of_procs=1):
+        """
+        Create the server(s) and run the IOLoop.
+
+        :param int port_number: the port number to bind the server to
+        :param int number_of_procs: number of worker processes to run.
+            Zero runs one worker per CPU.  This is ignored in *debug*
+            mode.
+
+        The *before_run* callbacks are invoked in each worker before
+        its server is started.  If a callback raises an exception,
+        then the worker exits with status 70.
+
+        """
+        if number_of_procs == 0:
+            number_of_procs = process.cpu_count()
+        if self.application.settings.get('debug', False):
+            number_of_procs = 1
+
+        self.sockets = netutil.bind_sockets(port_number)
+        if number_of_procs > 1:
+            self.logger.info('starting %d workers on port %d',
+                             number_of_procs, port_number)
+            self.supervise(number_of_procs)
+
+        iol = ioloop.IOLoop.instance()
+        for callback in self.application.runner_callbacks['before_run']:
+            try:
+                callback(self.application, iol)
+            except Exception:
+                self.logger.error('before_run callback %r cancelled start',
+                                  callback, exc_info=1)
+                sys.exit(70)
+
+        self.start_server(port_number, number_of_procs)
+        for callback in self.application.runner_callbacks['on_start']:
+            iol.spawn_callback(callback, self.application, iol)
+        iol.start()
+
+    def supervise(self, number_of_procs):
+        """
+        Fork the workers and wait for them to exit.
+
+        :returns: :data:`True` in a newly forked worker process.  The
+            supervisor process calls :func:`sys.exit` once every
+            worker has exited.
+
+        """
+        signal.signal(signal.SIGTERM, self._on_supervisor_signal)
+        signal.signal(signal.SIGINT, self._on_supervisor_signal)
+
+        for worker_id in range(number_of_procs):
+            if self._spawn_worker(worker_id):
+                return True
+
+        last_failure = 0.0
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            worker_id = self.workers.pop(pid, None)
+            if worker_id is None:
+                continue
+            if self.stopping:
+                self.logger.info('worker %d (pid %d) exited', worker_id, pid)
+                continue
+
+            if os.WIFSIGNALED(status):
+                self.logger.warning('worker %d (pid %d) killed by signal %d',
+                                    worker_id, pid, os.WTERMSIG(status))
+            else:
+                self.logger.warning('worker %d (pid %d) exited with %d',
+                                    worker_id, pid, os.WEXITSTATUS(status))
+
+            now = time.monotonic()
+            if now - last_failure > self.max_restart_delay * 2:
+                self.restart_delay = 0.0
+            last_failure = now
+            if self.restart_delay:
+                self.logger.info('restarting worker %d in %.1f seconds',
+                                 worker_id, self.restart_delay)
+                time.sleep(self.restart_delay)
+            self.restart_delay = min(max(self.restart_delay * 2, 0.5),
+                                     self.max_restart_delay)
+            if not self.stopping and self._spawn_worker(worker_id):
+                return True
+
+        self.logger.info('all workers have exited')
+        sys.exit(0)
+
+    def _spawn_worker(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            random.seed()
+            self.workers = {}
+            return True
+
+        self.logger.debug('started worker %d as pid %d', worker_id, pid)
+        self.workers[pid] = worker_id
+        return False
+
+    def _on_supervisor_signal(self, signo, frame):
+        if self.stopping:
+            self.logger.warning('signal %s received again, killing workers',
+                                signo)
+            forward = signal.SIGKILL
+        else:
+            self.logger.info('signal %s received, stopping workers', signo)
+            forward = signal.SIGTERM
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, forward)
+            except ProcessLookupError:
+                pass
@@ -1,62 +1,146 @@
 require.config({
   paths: {
     "jquery": "lib/jquery-3.1.0.min",
-    "moment": "lib/moment-2.15.0.min",
-    "transparency": "lib/transparency-0.11.0.min"
+    "moment": "lib/moment-2.15.0.min"
   }
 });
-require(["jquery", "moment", "transparency"],
-  function (jQuery, moment, transparency) {
+require(["jquery", "moment"],
+  function (jQuery, moment) {
     "use strict";
-    jQuery.fn.render = transparency.jQueryPlugin;
 
-    function renderList(data) {
-      if (data.redirect) {
-        document.location.assign(data.redirect);
+    var list = jQuery("#readings"),
+      template = list.children("li.reading").first().detach(),
+      rendered = {}, nextPage = null, loadingPage = false,
+      syncToken = null, syncing = false, streamOpened = false;
+
+    function parseNextLink(header) {
+      var match = /<([^>]*)>\s*;\s*rel="?next"?/.exec(header || "");
+      return match ? match[1] : null;
+    }
+
+    function renderReading(reading) {
+      var item = template.clone();
+      item.data("reading", reading);
+      item.find(".reading-title").text(reading.title);
+      item.find(".small-link").text(reading.href);
+      item.find(".added").text("added " + moment(reading.added).fromNow());
+      return item;
+    }
+
+    function addReadings(readings, prepend) {
+      var items = [];
+      readings.forEach(function (reading) {
+        if (!rendered.hasOwnProperty(reading.link)) {
+          rendered[reading.link] = renderReading(reading);
+          items.push(rendered[reading.link]);
+        }
+      });
+      if (prepend) {
+        list.prepend(items);
       } else {
-        jQuery("#readings").render(data, {
-          "added": {
-            "text": function () {
-              var parsed = moment(this.added);
-              return "added " + parsed.fromNow();
-            }
-          },
-          "link": {
-            "goto-reading": function () {
-              return this.href;
-            },
-            "remove-reading": function () {
-              return this.link;
-            },
-            "text": function () {
-              return "";
-            }
-          }
-        });
-        jQuery("li.reading div").on("click", function (event) {
-          event.preventDefault();
-          window.open(this.parentElement["goto-reading"]);
-        });
-        jQuery("li.reading").mouseenter(function (event) {
-          $(this).children("button.remove-reading").show();
-        });
-        jQuery("li.reading").mouseleave(function (event) {
-          $(this).children("button.remove-reading").hide();
-        });
-        jQuery(".remove-reading").on("click", function (event) {
-          event.preventDefault();
-          jQuery.ajax({
-            "url": this.parentElement["remove-reading"],
-            "method": "DELETE"
-          }).done(function() {
-            jQuery.ajax({
-              "url": "/",
-              "method": "GET",
-              "dataType": "json"
-            }).done(renderList).fail(showError);
-          });
-        });
+        list.append(items);
+      }
+    }
+
+    function removeReading(link) {
+      if (rendered.hasOwnProperty(link)) {
+        rendered[link].remove();
+        delete rendered[link];
+      }
+    }
+
+    function readingOf(element) {
+      return jQuery(element).closest("li.reading").data("reading");
+    }
+
+    function loadPage(url, reset) {
+      if (loadingPage) {
+        return;
+      }
+      loadingPage = true;
+      jQuery.ajax({
+        "url": url,
+        "method": "GET",
+        "dataType": "json",
+        "headers": {"X-Requested-With": "XMLHTTPRequest"}
+      }).done(function (data, status, jqxhr) {
+        if (data.redirect) {
+          document.location.assign(data.redirect);
+          return;
+        }
+        if (reset) {
+          list.empty();
+          rendered = {};
+          syncToken = jqxhr.getResponseHeader("Sync-Token");
+        }
+        addReadings(data, false);
+        nextPage = parseNextLink(jqxhr.getResponseHeader("Link"));
+        jQuery("#more-readings").toggleClass("hidden", nextPage === null);
+      }).fail(showError).always(function () {
+        loadingPage = false;
+      });
+    }
+
+    function loadFirstPage() {
+      loadPage("/", true);
+    }
+
+    function loadNextPage() {
+      if (nextPage !== null) {
+        loadPage(nextPage, false);
+      }
+    }
+
+    function syncChanges() {
+      if (syncToken === null) {
+        loadFirstPage();
+        return;
+      }
+      if (syncing || loadingPage) {
+        return;
+      }
+      syncing = true;
+      jQuery.ajax({
+        "url": "/",
+        "method": "GET",
+        "data": {"since": syncToken},
+        "dataType": "json",
+        "headers": {"X-Requested-With": "XMLHTTPRequest"}
+      }).done(function (data) {
+        data.removed.forEach(removeReading);
+        addReadings(data.added, true);
+        syncToken = data.token;
+      }).fail(function (jqxhr, status, error) {
+        // the changes are no longer available
+        if (jqxhr.status === 410) {
+          loadFirstPage();
+        } else {
+          showError(jqxhr, status, error);
+        }
+      }).always(function () {
+        syncing = false;
+      });
+    }
+
+    function listenForChanges() {
+      if (!window.EventSource) {
+        return;
       }
+      var source = new window.EventSource("/events");
+      source.addEventListener("open", function () {
+        // changes may have been missed while reconnecting
+        if (streamOpened) {
+          syncChanges();
+        }
+        streamOpened = true;
+      });
+      source.addEventListener("add", function (event) {
+        addReadings([JSON.parse(event.data)], true);
+      });
+      source.addEventListener("remove", function (event) {
+        removeReading(JSON.parse(event.data).link);
+      });
+      source.addEventListener("reset", loadFirstPage);
     }
 
     function showError(jqxhr, status, error) {
@@ -64,10 +148,44 @@ require(["jquery", "moment", "transparency"],
       console.log(error);
     }
 
-    jQuery.ajax({
-      "url": "/",
-      "dataType": "json"
-    }).done(renderList).fail(showError);
+    loadFirstPage();
+    listenForChanges();
+    window.setInterval(syncChanges, 60000);
+
+    list.on("click", "li.reading div", function (event) {
+      event.preventDefault();
+      window.open(readingOf(this).href);
+    });
+    list.on("mouseenter", "li.reading", function () {
+      jQuery(this).children("button.remove-reading").show();
+    });
+    list.on("mouseleave", "li.reading", function () {
+      jQuery(this).children("button.remove-reading").hide();
+    });
+    list.on("click", ".remove-reading", function (event) {
+      event.preventDefault();
+      var link = readingOf(this).link;
+      jQuery.ajax({
+        "url": link,
+        "method": "DELETE",
+        "dataType": "json"
+      }).done(function () {
+        removeReading(link);
+      }).fail(showError);
+    });
+
+    jQuery("#more-readings").on("click", function (event) {
+      event.preventDefault();
+      loadNextPage();
+    });
+
+    jQuery(window).on("scroll", function () {
+      var remaining = jQuery(document).height() -
+        (jQuery(window).scrollTop() + jQuery(window).height());
+      if (remaining < 200) {
+        loadNextPage();
+      }
+    });
 
     jQuery("#logout").on("click", function (event) {
       event.preventDefault();
@@ -94,16 +212,9 @@ require(["jquery", "moment", "transparency"],
           "method": "POST",
           "data": jQuery("#add-form").serialize(),
           "dataType": "json"
-        }).done(function() {
-          jQuery.ajax({
-            "url": "/",
-            "method": "GET",
-            "dataType": "json",
-            "crossDomain": true,
-            "xhrFields": {"withCredentials": false},
-            "headers": {"X-Requested-With": "XMLHTTPRequest"}
-          }).done(renderList).fail(showError);
-        });
+        }).done(function (reading) {
+          addReadings([reading], true);
+        }).fail(showError);
       }
     });
 
@@ -0,0 +1,246 @@
+import collections
+import contextlib
+import cProfile
+import functools
+import heapq
+import inspect
+import logging
+import os
+import time
+
+from tornado import web
+
+
+class RequestTimings(object):
+    """
+    Time spent in each phase of a request.
+
+    Phases are timed with :meth:`phase` and accumulate when a phase is
+    entered more than once.  Phases may overlap -- for example, the
+    database time of the user lookup also counts towards ``db``.
+
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.durations = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, self.clock() - start)
+
+    def add(self, name, elapsed):
+        self.durations[name] = self.durations.get(name, 0.0) + elapsed
+
+    def as_dict(self):
+        """Return the phase durations in milliseconds."""
+        return {name: round(elapsed * 1000, 3)
+                for name, elapsed in self.durations.items()}
+
+    def format_header(self, total=None):
+        """
+        Format the durations as a :http:header:`Server-Timing` value.
+
+        :param float total: optional number of seconds that the whole
+            request took, which is reported as the ``total`` phase
+
+        """
+        entries = list(self.durations.items())
+        if total is not None:
+            entries.append(('total', total))
+        return ', '.join('{};dur={:.1f}'.format(name, elapsed * 1000)
+                         for name, elapsed in entries)
+
+
+class TimedClient(object):
+    """
+    Record the time spent waiting for a database client.
+
+    :param readings.helpers.MongoClient client: the client to wrap
+    :param RequestTimings timings: where the time is recorded
+
+    Every method that returns an awaitable is timed as the ``db``
+    phase.  The time spent in the batch callbacks of streaming
+    queries is left out, and the time spent fetching each batch is
+    recorded before its callback runs so that it is included if the
+    callback starts the response.
+
+    """
+
+    def __init__(self, client, timings):
+        self.client = client
+        self.timings = timings
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            if kwargs.get('on_batch') is not None:
+                return self._measure_stream(attr, *args, **kwargs)
+            result = attr(*args, **kwargs)
+            if inspect.isawaitable(result):
+                return self._measure(result)
+            return result
+
+        return timed
+
+    async def _measure(self, awaitable):
+        with self.timings.phase('db'):
+            return await awaitable
+
+    async def _measure_stream(self, method, *args, on_batch, **kwargs):
+        clock = self.timings.clock
+        resumed = clock()
+
+        async def timed_batch(batch):
+            nonlocal resumed
+            self.timings.add('db', clock() - resumed)
+            try:
+                result = on_batch(batch)
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
+            finally:
+                resumed = clock()
+
+        try:
+            return await method(*args, on_batch=timed_batch, **kwargs)
+        finally:
+            self.timings.add('db', clock() - resumed)
+
+
+class Profiler(object):
+    """
+    Profile a sample of requests and keep the slowest profiles.
+
+    :param int sample_rate: profile one in this many requests.  Zero
+        disables profiling.
+    :param str directory: where the profiles are written
+    :param int keep: number of profiles to retain
+
+    Profiles are written in the :mod:`pstats` format and named after
+    the route and the duration of the request.  Once `keep` profiles
+    have been written, a new profile is only written if its request
+    was slower than the fastest one retained, which is then removed.
+
+    :mod:`cProfile` profiles the whole thread so a profile includes
+    whatever else the IOLoop ran while the request was in progress.
+    Only one request is profiled at a time.
+
+    """
+
+    def __init__(self, sample_rate=0, directory=None, keep=20):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.keep = keep
+        self.requests = 0
+        self.written = 0
+        self.slowest = []
+        self._active = None
+
+    def start(self):
+        """Return a running profile if this request is sampled."""
+        if not self.sample_rate or self._active is not None:
+            return None
+        self.requests += 1
+        if self.requests % self.sample_rate:
+            return None
+        self._active = cProfile.Profile()
+        self._active.enable()
+        return self._active
+
+    def stop(self, profile, elapsed, label):
+        """Stop `profile` and write it if it is one of the slowest."""
+        profile.disable()
+        if profile is self._active:
+            self._active = None
+        if len(self.slowest) >= self.keep and elapsed <= self.slowest[0][0]:
+            return
+
+        self.written += 1
+        path = os.path.join(self.directory, '{}-{:.0f}ms-{}-{}.prof'.format(
+            label, elapsed * 1000, os.getpid(), self.written))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(path)
+        except OSError as error:
+            self.logger.warning('failed to write profile %s - %r', path,
+                                error)
+            return
+
+        self.logger.debug('wrote %.3fs profile to %s', elapsed, path)
+        heapq.heappush(self.slowest, (elapsed, path))
+        if len(self.slowest) > self.keep:
+            _, discarded = heapq.heappop(self.slowest)
+            try:
+                os.remove(discarded)
+            except OSError:
+                pass
+
+
+class TimingMixin(web.RequestHandler):
+    """
+    Break the time taken by each request down by phase.
+
+    :attr:`timings` records the ``db``, ``parse``, and ``serialize``
+    phases as well as any that the handler adds.  The phases are
+    reported in the :http:header:`Server-Timing` header and in the
+    access log.  :attr:`mongo` is the application's database client
+    wrapped in a :class:`TimedClient`.
+
+    The header of a streamed response only covers the work done before
+    the first chunk was sent, while the access log has the phases of
+    the whole request.
+
+    Requests are also sampled by the application's :class:`Profiler`
+    unless :attr:`profiled` is disabled.
+
+    """
+
+    profiled = True
+    """Can requests to this handler be profiled?"""
+
+    def initialize(self):
+        super(TimingMixin, self).initialize()
+        self.timings = RequestTimings()
+        self.mongo = TimedClient(self.application.mongo, self.timings)
+        self.profile = (self.application.profiler.start()
+                        if self.profiled else None)
+
+    def get_request_body(self):
+        with self.timings.phase('parse'):
+            return super(TimingMixin, self).get_request_body()
+
+    def send_response(self, body, set_content_type=True):
+        with self.timings.phase('serialize'):
+            return super(TimingMixin, self).send_response(
+                body, set_content_type=set_content_type)
+
+    def flush(self, include_footers=False, callback=None):
+        if not self._headers_written:
+            self.set_header('Server-Timing', self.timings.format_header(
+                self.request.request_time()))
+        return super(TimingMixin, self).flush(include_footers, callback)
+
+    def on_finish(self):
+        self._stop_profile()
+        super(TimingMixin, self).on_finish()
+
+    def on_connection_close(self):
+        self._stop_profile()
+        super(TimingMixin, self).on_connection_close()
+
+    def _stop_profile(self):
+        if self.profile is not None:
+            profile, self.profile = self.profile, None
+            self.application.profiler.stop(
+                profile, self.request.request_time(),
+                self.application.route_names.get(self.__class__, 'other'))
@@ -33,6 +33,8 @@ setuptools.setup(
     package_data={'': ['*.css', '*.html', '*.js']},
     include_package_data=True,
     install_requires=read_requirements('requirements.txt'),
+    extras_require={'brotli': ['brotli==1.2.0'],
+                    'msgpack': ['u-msgpack-python==2.8.0']},
     entry_points={'console_scripts': ['readings=readings.app:main']},
     classifiers=['Development Status :: 5 - Production/Stable',
                  'Environment :: Web Environment',